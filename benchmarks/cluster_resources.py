@@ -0,0 +1,102 @@
+"""
+Micro-benchmark for the cluster resources collector.
+
+Measures the per-resource cost of building the metric families from a
+synthetic cluster/resources response and of rendering them in the Prometheus
+text format.
+
+    python benchmarks/cluster_resources.py [--resources 10000] [--repeat 5]
+"""
+
+import argparse
+import random
+import time
+import types
+
+from pve_exporter.collector.cluster import ClusterResourcesCollector
+from pve_exporter.exposition import choose_encoder
+
+
+def synthetic_resources(count, seed=0):
+    """
+    Return a list of count cluster resources resembling the output of the
+    PVE cluster/resources endpoint.
+    """
+    rnd = random.Random(seed)
+    nodes = max(1, count // 500)
+    resources = []
+    for index in range(nodes):
+        resources.append({
+            'id': f'node/pve{index}', 'type': 'node', 'node': f'pve{index}',
+            'status': 'online', 'cpu': rnd.random(), 'maxcpu': 64,
+            'mem': rnd.randrange(1 << 36), 'maxmem': 1 << 38,
+            'disk': rnd.randrange(1 << 34), 'maxdisk': 1 << 36,
+            'uptime': rnd.randrange(1 << 24),
+        })
+        resources.append({
+            'id': f'storage/pve{index}/local', 'type': 'storage', 'node': f'pve{index}',
+            'storage': 'local', 'plugintype': 'dir', 'content': 'iso,backup,vztmpl',
+            'status': 'available', 'shared': 0,
+            'disk': rnd.randrange(1 << 36), 'maxdisk': 1 << 40,
+        })
+
+    for vmid in range(100, 100 + count - len(resources)):
+        running = rnd.random() < 0.8
+        resources.append({
+            'id': f"{'qemu' if vmid % 2 else 'lxc'}/{vmid}", 'vmid': vmid,
+            'type': 'qemu' if vmid % 2 else 'lxc', 'node': f'pve{vmid % nodes}',
+            'name': f'guest-{vmid}', 'status': 'running' if running else 'stopped',
+            'template': 0, 'tags': 'prod;web', 'hastate': 'started' if vmid % 7 == 0 else None,
+            'cpu': rnd.random() if running else 0, 'maxcpu': 4,
+            'mem': rnd.randrange(1 << 32) if running else 0, 'maxmem': 1 << 33,
+            'disk': 0, 'maxdisk': 1 << 35,
+            'netin': rnd.randrange(1 << 40), 'netout': rnd.randrange(1 << 40),
+            'diskread': rnd.randrange(1 << 40), 'diskwrite': rnd.randrange(1 << 40),
+            'uptime': rnd.randrange(1 << 24) if running else 0,
+        })
+
+    return resources
+
+
+def _best_of(repeat, func):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def main():  # pylint: disable=missing-docstring
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--resources', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    params = parser.parse_args()
+
+    resources = synthetic_resources(params.resources)
+    pve = types.SimpleNamespace(
+        cluster=types.SimpleNamespace(
+            resources=types.SimpleNamespace(get=lambda: resources)
+        )
+    )
+    encoder, _ = choose_encoder(None)
+
+    build, families = _best_of(
+        params.repeat,
+        lambda: list(ClusterResourcesCollector(pve).collect())
+    )
+    collector = types.SimpleNamespace(collect=lambda: iter(families))
+    render, output = _best_of(params.repeat, lambda: encoder(collector))
+
+    count = len(resources)
+    print(f"resources: {count}, samples: {sum(len(f.samples) for f in families)}, "
+          f"output: {len(output)} bytes")
+    print(f"build:  {build * 1000:8.1f} ms total {build / count * 1e6:8.2f} us/resource")
+    print(f"render: {render * 1000:8.1f} ms total {render / count * 1e6:8.2f} us/resource")
+
+
+if __name__ == '__main__':
+    main()
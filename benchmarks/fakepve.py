@@ -0,0 +1,250 @@
+"""
+Local stand-in for the PVE API (pveproxy) used by the benchmarks.
+
+Serves synthetic cluster/status, cluster/resources, guest list, guest config,
+replication and the remaining endpoints queried by the exporter over TLS for a
+cluster of configurable size. Every API response is delayed by a configurable
+latency. Requests are counted per endpoint, the counters are available from
+the /_calls path (and reset using DELETE /_calls).
+
+    python benchmarks/fakepve.py [--nodes 3] [--guests 100] [--jobs 2] [--latency 0.005]
+
+The listening port is printed on stdout once the server accepts
+connections. Requires the openssl command line tool in order to generate a
+self-signed certificate.
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+
+class FakeCluster:
+    """
+    Synthetic PVE cluster with nodes, guests, storages and replication jobs.
+
+    The first node is the one the API is queried on, i.e., it is marked as
+    local in cluster/status.
+    """
+
+    def __init__(self, nodes=3, guests=100, jobs=2):
+        self.nodes = [f'pve{index + 1}' for index in range(nodes)]
+        self.guests = guests
+        self.jobs = jobs
+
+    def guests_of(self, node):
+        """
+        Return (type, vmid) tuples of the guests placed on a node.
+        """
+        offset = 100 + self.nodes.index(node) * 100000
+        return [
+            ('qemu' if index % 4 else 'lxc', offset + index)
+            for index in range(self.guests)
+        ]
+
+    def cluster_status(self):  # pylint: disable=missing-docstring
+        return [{
+            'type': 'cluster', 'id': 'cluster', 'name': 'bench',
+            'nodes': len(self.nodes), 'quorate': 1, 'version': 7,
+        }] + [{
+            'type': 'node', 'id': f'node/{node}', 'name': node, 'nodeid': index + 1,
+            'online': 1, 'local': int(index == 0), 'level': '', 'ip': f'10.0.0.{index + 1}',
+        } for index, node in enumerate(self.nodes)]
+
+    def cluster_resources(self, restype=None):  # pylint: disable=missing-docstring
+        resources = []
+        for node in self.nodes:
+            if restype is None:
+                resources.append({
+                    'type': 'node', 'id': f'node/{node}', 'node': node, 'status': 'online',
+                    'hastate': 'online', 'cpu': 0.25, 'maxcpu': 64, 'mem': 1 << 36,
+                    'maxmem': 1 << 38, 'disk': 1 << 34, 'maxdisk': 1 << 36, 'uptime': 864000,
+                })
+            if restype in (None, 'storage'):
+                resources.append({
+                    'type': 'storage', 'id': f'storage/{node}/local', 'node': node,
+                    'storage': 'local', 'plugintype': 'dir', 'content': 'vztmpl,iso,backup',
+                    'status': 'available', 'shared': 0, 'disk': 1 << 36, 'maxdisk': 1 << 40,
+                })
+            if restype in (None, 'vm'):
+                for vmtype, vmid in self.guests_of(node):
+                    resource = {
+                        'type': vmtype, 'id': f'{vmtype}/{vmid}', 'vmid': vmid, 'node': node,
+                        'name': f'guest-{vmid}', 'status': 'running', 'template': 0,
+                        'tags': 'bench;web', 'cpu': 0.1, 'maxcpu': 4, 'mem': 1 << 31,
+                        'maxmem': 1 << 33, 'disk': 0, 'maxdisk': 1 << 35, 'netin': vmid << 10,
+                        'netout': vmid << 11, 'diskread': vmid << 12, 'diskwrite': vmid << 13,
+                        'uptime': 3600,
+                    }
+                    if vmid % 10 == 0:
+                        resource['hastate'] = 'started'
+                    if vmid % 50 == 0:
+                        resource['lock'] = 'backup'
+                    resources.append(resource)
+
+        return resources
+
+    def replication(self, node):  # pylint: disable=missing-docstring
+        target = self.nodes[(self.nodes.index(node) + 1) % len(self.nodes)]
+        return [{
+            'id': f'{vmid}-0', 'type': 'local', 'source': node, 'target': target,
+            'vmtype': vmtype, 'guest': vmid, 'jobnum': 0, 'duration': 2.5,
+            'last_sync': 1700000000, 'last_try': 1700000000, 'next_sync': 1700000900,
+            'fail_count': 0,
+        } for vmtype, vmid in self.guests_of(node)[:self.jobs]]
+
+    def respond(self, path, query):
+        """
+        Return the data for an API path or None if the path is unknown.
+        """
+        # pylint: disable=too-many-return-statements
+        static = {
+            '/version': {'release': '8.2', 'repoid': 'bench', 'version': '8.2.4'},
+            '/cluster/status': self.cluster_status,
+            '/cluster/backup-info/not-backed-up': lambda: [],
+            '/cluster/config/qdevice': lambda: {},
+        }
+        if path in static:
+            return static[path]() if callable(static[path]) else static[path]
+
+        if path == '/cluster/resources':
+            return self.cluster_resources(query.get('type', [None])[0])
+
+        match = re.fullmatch(r'/nodes/([^/]+)/(.*)', path)
+        if not match or match.group(1) not in self.nodes:
+            return None
+
+        node, rest = match.groups()
+        if rest in ('qemu', 'lxc'):
+            return [
+                {'vmid': vmid, 'name': f'guest-{vmid}', 'status': 'running'}
+                for vmtype, vmid in self.guests_of(node) if vmtype == rest
+            ]
+        if re.fullmatch(r'(qemu|lxc)/\d+/config', rest):
+            return {'onboot': 1, 'cores': 4, 'memory': 8192, 'digest': 'bench'}
+        if rest == 'replication':
+            return self.replication(node)
+        if re.fullmatch(r'replication/[^/]+/status', rest):
+            return self.replication(node)[0]
+        if rest == 'subscription':
+            return {'status': 'notfound'}
+
+        return None
+
+
+class FakePveHandler(BaseHTTPRequestHandler):
+    """
+    Request handler serving the API of the FakeCluster set on the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately. Avoid delayed ACK stalls.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _send(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _count(self, path):
+        # Replace numeric ids such that calls are counted per endpoint.
+        with self.server.lock:
+            self.server.calls[re.sub(r'/\d+(?=/|$)', '/{vmid}', path)] += 1
+
+    def do_GET(self):  # pylint: disable=invalid-name,missing-docstring
+        url = urlsplit(self.path)
+        if url.path == '/_calls':
+            with self.server.lock:
+                self._send(200, dict(self.server.calls))
+            return
+
+        self._count(url.path)
+        time.sleep(self.server.latency)
+        data = self.server.cluster.respond(url.path[len('/api2/json'):], parse_qs(url.query))
+        if data is None:
+            self._send(404, {'data': None})
+        else:
+            self._send(200, {'data': data})
+
+    def do_POST(self):  # pylint: disable=invalid-name,missing-docstring
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._count(urlsplit(self.path).path)
+        self._send(200, {'data': {'ticket': 'PVE:bench', 'CSRFPreventionToken': 'bench'}})
+
+    def do_DELETE(self):  # pylint: disable=invalid-name,missing-docstring
+        with self.server.lock:
+            self.server.calls.clear()
+        self._send(200, {'data': None})
+
+
+def _self_signed_context(directory):
+    """
+    Return a server SSL context using a freshly generated self-signed
+    certificate.
+    """
+    certfile = os.path.join(directory, 'fakepve.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-subj', '/CN=localhost', '-keyout', certfile, '-out', certfile,
+    ], check=True, capture_output=True)
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile)
+    return context
+
+
+def add_cluster_arguments(parser):
+    """
+    Add the arguments defining the size and latency of the fake cluster.
+    """
+    parser.add_argument('--nodes', type=int, default=3, help='Number of nodes')
+    parser.add_argument('--guests', type=int, default=100, help='Number of guests per node')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='Number of replication jobs per node')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds every API response is delayed')
+
+
+def main():  # pylint: disable=missing-docstring
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_cluster_arguments(parser)
+    parser.add_argument('--port', type=int, default=0, help='Listening port')
+    params = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', params.port), FakePveHandler)
+    server.daemon_threads = True
+    server.cluster = FakeCluster(params.nodes, params.guests, params.jobs)
+    server.latency = params.latency
+    server.calls = collections.Counter()
+    server.lock = threading.Lock()
+
+    with tempfile.TemporaryDirectory() as directory:
+        server.socket = _self_signed_context(directory).wrap_socket(
+            server.socket, server_side=True
+        )
+
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Benchmark harness for Proxmox VE prometheus collector.
+
+Starts the fake PVE API from fakepve.py in a separate process and scrapes it
+repeatedly, once per collector and once with all collectors enabled, by
+calling collect_pve directly, and finally through the WSGI application. For
+every run it reports scrape latency percentiles, CPU time, API calls and peak
+memory (as traced by tracemalloc) per scrape.
+
+    python benchmarks/scrape.py [--nodes 3] [--guests 100] [--latency 0.005] \\
+        [--scrapes 20] [--setting request_concurrency=8 ...]
+
+CPU time is the process time of the exporter, the fake API runs in another
+process. Peak memory is measured in a separate scrape, because tracing
+allocations slows down the exporter considerably.
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import requests
+import urllib3
+import yaml
+from werkzeug.test import Client
+
+from pve_exporter.collector import CollectorsOptions, collect_pve
+from pve_exporter.exposition import choose_encoder
+from pve_exporter.http import PveExporterApplication
+
+from fakepve import add_cluster_arguments
+
+NODE_COLLECTORS = ['subscription', 'config', 'replication']
+"""
+Collectors which run if the node url parameter is set. All others are cluster
+collectors.
+"""
+
+
+@contextmanager
+def fake_pve(params):
+    """
+    Run the fake PVE API in a subprocess and yield its base url.
+    """
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        [
+            sys.executable, os.path.join(os.path.dirname(__file__), 'fakepve.py'),
+            '--nodes', str(params.nodes),
+            '--guests', str(params.guests),
+            '--jobs', str(params.jobs),
+            '--latency', str(params.latency),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        port = int(process.stdout.readline())
+        yield f'127.0.0.1:{port}'
+    finally:
+        process.terminate()
+        process.wait()
+
+
+class CallCounter:
+    """
+    Reads and resets the per endpoint request counters of the fake PVE API.
+    """
+
+    def __init__(self, target):
+        self._url = f'https://{target}/_calls'
+        self._session = requests.Session()
+
+    def reset(self):  # pylint: disable=missing-docstring
+        self._session.delete(self._url, verify=False).raise_for_status()
+
+    def total(self):
+        """
+        Return the number of API requests since the last reset.
+        """
+        response = self._session.get(self._url, verify=False)
+        response.raise_for_status()
+        return sum(response.json().values())
+
+
+def percentile(values, fraction):
+    """
+    Return the nearest-rank percentile of a non-empty list of values.
+    """
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def measure(scrape, count, calls):
+    """
+    Run scrape count times after one warm-up run and return a dictionary of
+    results.
+    """
+    scrape()
+
+    calls.reset()
+    durations = []
+    cpu_start = time.process_time()
+    for _ in range(count):
+        start = time.perf_counter()
+        scrape()
+        durations.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu_start
+    api_calls = calls.total()
+
+    tracemalloc.start()
+    scrape()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'p50': percentile(durations, 0.5),
+        'p90': percentile(durations, 0.9),
+        'p99': percentile(durations, 0.99),
+        'cpu': cpu / count,
+        'calls': api_calls / count,
+        'peak': peak,
+    }
+
+
+def _collector_options(enabled):
+    return CollectorsOptions(**{
+        name: name in enabled for name in CollectorsOptions._fields
+    })
+
+
+def collect_scrape(config, target, names):
+    """
+    Return a function scraping target with the named collectors using
+    collect_pve and rendering the result in the Prometheus text format.
+    """
+    options = _collector_options(names)
+    cluster = any(name not in NODE_COLLECTORS for name in names)
+    node = any(name in NODE_COLLECTORS for name in names)
+    encoder, _ = choose_encoder(None)
+
+    def scrape():
+        return encoder(collect_pve(config, target, cluster, node, options))
+
+    return scrape
+
+
+def wsgi_scrape(config, target):
+    """
+    Return a function scraping target through the exporter's WSGI application
+    with all collectors enabled.
+    """
+    app = PveExporterApplication(
+        {'default': config},
+        _collector_options(CollectorsOptions._fields),
+        logging.getLogger('benchmark')
+    )
+    client = Client(app)
+
+    def scrape():
+        response = client.get('/pve', query_string={'target': target})
+        if response.status_code != 200:
+            raise RuntimeError(response.get_data(as_text=True))
+        return response.get_data()
+
+    return scrape
+
+
+def _parse_setting(value):
+    key, _, setting = value.partition('=')
+    return key, yaml.safe_load(setting)
+
+
+def main():  # pylint: disable=missing-docstring
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_cluster_arguments(parser)
+    parser.add_argument('--scrapes', type=int, default=20,
+                        help='Number of measured scrapes per run')
+    parser.add_argument('--setting', type=_parse_setting, action='append', default=[],
+                        help='Exporter setting of the module config, e.g., '
+                        'request_concurrency=8. May be repeated.')
+    params = parser.parse_args()
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    config = {
+        'user': 'bench@pve',
+        'token_name': 'bench',
+        'token_value': 'bench',
+        'verify_ssl': False,
+    }
+    config.update(params.setting)
+
+    print(f"nodes: {params.nodes}, guests per node: {params.guests}, "
+          f"latency: {params.latency * 1000:.1f} ms, scrapes: {params.scrapes}")
+    print(f"{'run':<14}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+          f"{'cpu ms':>10}{'api calls':>11}{'peak KiB':>11}")
+
+    with fake_pve(params) as target:
+        calls = CallCounter(target)
+        runs = [
+            (name, collect_scrape(config, target, [name]))
+            for name in CollectorsOptions._fields
+        ]
+        runs.append(('all', collect_scrape(config, target, CollectorsOptions._fields)))
+        runs.append(('wsgi', wsgi_scrape(config, target)))
+
+        for name, scrape in runs:
+            result = measure(scrape, params.scrapes, calls)
+            print(f"{name:<14}{result['p50'] * 1000:>10.1f}{result['p90'] * 1000:>10.1f}"
+                  f"{result['p99'] * 1000:>10.1f}{result['cpu'] * 1000:>10.1f}"
+                  f"{result['calls']:>11.1f}{result['peak'] / 1024:>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
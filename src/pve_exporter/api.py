@@ -0,0 +1,678 @@
+"""
+Helpers for accessing the Proxmox VE API from collectors.
+"""
+
+import collections
+import contextlib
+import contextvars
+import copy
+import logging
+import threading
+import time
+from functools import partial
+from urllib.parse import urlsplit, urlunsplit
+
+from proxmoxer import AuthenticationError, ProxmoxAPI, ResourceException
+from requests.exceptions import ConnectionError as RequestsConnectionError
+
+TICKET_LIFETIME = 7200
+"""
+Seconds after which a PVE authentication ticket expires.
+"""
+
+TICKET_RENEW_MARGIN = 600
+"""
+Seconds before ticket expiry after which a pooled client is replaced instead
+of relying on proxmoxer to renew the ticket.
+"""
+
+ENDPOINT_LATENCY_WEIGHT = 0.3
+"""
+Weight of the latest request duration in the moving latency average of an
+endpoint.
+"""
+
+ENDPOINT_RETRY_INTERVAL = 30
+"""
+Seconds an endpoint is avoided after a failed request. Latency averages older
+than this are measured again.
+"""
+
+ENDPOINT_DISCOVERY_INTERVAL = 300
+"""
+Seconds after which discovered endpoints are refreshed from cluster/status.
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+
+SCRAPE_DEADLINE = contextvars.ContextVar('pve_scrape_deadline', default=None)
+"""
+Monotonic time by which the scrape in progress must be finished or None if
+the scrape is not time limited.
+"""
+
+
+_PINNED = contextvars.ContextVar('pve_pinned_to_target', default=False)
+"""
+Whether or not API requests must be answered by the scrape target itself.
+"""
+
+
+@contextlib.contextmanager
+def pinned_to_target():
+    """
+    Send the API requests issued within the context to the scrape target
+    itself, even if the client fails over between endpoints. Needed for
+    responses which depend on the answering node, e.g., the local flag of
+    cluster/status.
+    """
+    token = _PINNED.set(True)
+    try:
+        yield
+    finally:
+        _PINNED.reset(token)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when an API request is attempted after the scrape deadline.
+    """
+
+
+def remaining_time():
+    """
+    Return the number of seconds left until the scrape deadline or None if
+    there is no deadline.
+    """
+    deadline = SCRAPE_DEADLINE.get()
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
+
+
+class DeadlineSession:
+    """
+    Wraps the HTTP session of a proxmoxer client and bounds requests by the
+    scrape deadline.
+
+    The timeout of every request is capped to the time left until the
+    deadline. Requests are refused once the deadline has passed.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, session):
+        self._session = session
+
+    def __getattr__(self, item):
+        return getattr(self._session, item)
+
+    def request(self, method, url, data=None, params=None):
+        """
+        Issue a request, bounded by the scrape deadline if there is one.
+        """
+        remaining = remaining_time()
+        if remaining is None:
+            return self._session.request(method, url, data=data, params=params)
+
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Scrape deadline exceeded before {method} {url}")
+
+        timeout = getattr(self._session.auth, 'timeout', None)
+        if timeout:
+            remaining = min(remaining, timeout)
+
+        return self._session.request(method, url, data=data, params=params, timeout=remaining)
+
+
+def _netloc(endpoint, port):
+    """
+    Return the network location of an endpoint given as host, host:port,
+    ipv6 or [ipv6]:port. Use port if the endpoint does not specify one.
+    """
+    if endpoint.startswith('['):
+        return endpoint if ']:' in endpoint else f'{endpoint}:{port}'
+    if endpoint.count(':') > 1:
+        return f'[{endpoint}]:{port}'
+    if ':' in endpoint:
+        return endpoint
+    return f'{endpoint}:{port}'
+
+
+class _EndpointState:
+    """
+    Moving latency average and health of a single endpoint.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.latency = None
+        self.measured_at = 0
+        self.failed_at = None
+
+
+class EndpointSelector:
+    """
+    Orders the API endpoints of a cluster by health and latency.
+
+    Latency is tracked as exponentially weighted moving average of request
+    durations. Endpoints are avoided for ENDPOINT_RETRY_INTERVAL seconds after
+    a failed request. Endpoints without a recent measurement are preferred,
+    such that every endpoint is probed now and then.
+
+    If discover is set, endpoints are additionally learned from the ip
+    addresses of the online nodes in cluster/status.
+    """
+
+    def __init__(self, target, endpoints=(), discover=False):
+        self._lock = threading.Lock()
+        self._configured = [target] + [str(endpoint) for endpoint in endpoints]
+        self._states = {endpoint: _EndpointState() for endpoint in self._configured}
+        self._discover = discover
+        self._discovered_at = None
+
+    def discovery_due(self):
+        """
+        Return true if endpoints should be learned from cluster/status.
+        """
+        return self._discover and (
+            self._discovered_at is None or
+            time.monotonic() - self._discovered_at >= ENDPOINT_DISCOVERY_INTERVAL
+        )
+
+    def discover(self, status):
+        """
+        Replace the discovered endpoints by the ip addresses of the online
+        nodes listed in the given cluster/status response.
+        """
+        discovered = [
+            entry['ip'] for entry in status
+            if entry['type'] == 'node' and entry.get('online') and entry.get('ip')
+        ]
+        with self._lock:
+            self._states = {
+                endpoint: self._states.get(endpoint) or _EndpointState()
+                for endpoint in self._configured + discovered
+            }
+            self._discovered_at = time.monotonic()
+
+    def candidates(self):
+        """
+        Return all endpoints in the order they should be tried.
+        """
+        now = time.monotonic()
+        with self._lock:
+            states = list(self._states.items())
+
+        def _latency(item):
+            state = item[1]
+            if state.latency is None or now - state.measured_at >= ENDPOINT_RETRY_INTERVAL:
+                return 0
+            return state.latency
+
+        healthy = [
+            item for item in states
+            if item[1].failed_at is None or now - item[1].failed_at >= ENDPOINT_RETRY_INTERVAL
+        ]
+        failed = [item for item in states if item not in healthy]
+        return [endpoint for endpoint, _ in sorted(healthy, key=_latency)] + [
+            endpoint for endpoint, _ in sorted(failed, key=lambda item: item[1].failed_at)
+        ]
+
+    def record_success(self, endpoint, duration):
+        """
+        Update the latency average of an endpoint after a request.
+        """
+        with self._lock:
+            state = self._states.get(endpoint)
+            if state is None:
+                return
+            if state.latency is None:
+                state.latency = duration
+            else:
+                state.latency += ENDPOINT_LATENCY_WEIGHT * (duration - state.latency)
+            state.measured_at = time.monotonic()
+            state.failed_at = None
+
+    def record_failure(self, endpoint):
+        """
+        Mark an endpoint as unhealthy after a failed request.
+        """
+        with self._lock:
+            state = self._states.get(endpoint)
+            if state is not None:
+                state.latency = None
+                state.failed_at = time.monotonic()
+
+
+class EndpointSelectors:
+    """
+    Keeps one EndpointSelector per (module, target) across scrapes.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._selectors = {}
+
+    def selector(self, key, host, endpoints):
+        """
+        Return the selector for key or None if no endpoints are configured.
+        Endpoints is either a list of alternative hosts or the string
+        'discover'.
+        """
+        if not endpoints:
+            return None
+
+        with self._lock:
+            selector = self._selectors.get(key)
+            if selector is None:
+                if endpoints == 'discover':
+                    selector = EndpointSelector(host, discover=True)
+                else:
+                    selector = EndpointSelector(host, endpoints)
+                self._selectors[key] = selector
+
+            return selector
+
+
+class FailoverSession:
+    """
+    Wraps the HTTP session of a proxmoxer client and sends GET requests to
+    the best endpoint of an EndpointSelector.
+
+    If a request fails without a response, e.g., because it timed out, it is
+    repeated on the next endpoint. Other requests as well as requests pinned
+    to the target (see pinned_to_target) are sent to the original url
+    unchanged.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, session, selector):
+        self._session = session
+        self._selector = selector
+
+    def __getattr__(self, item):
+        return getattr(self._session, item)
+
+    def request(self, method, url, data=None, params=None):
+        """
+        Issue a request, failing over to other endpoints on errors.
+        """
+        if method != 'GET' or _PINNED.get():
+            return self._session.request(method, url, data=data, params=params)
+
+        parts = urlsplit(url)
+        candidates = self._selector.candidates()
+        for index, endpoint in enumerate(candidates):
+            endpoint_url = urlunsplit(parts._replace(netloc=_netloc(endpoint, parts.port)))
+            start = time.monotonic()
+            try:
+                response = self._session.request(method, endpoint_url, data=data, params=params)
+            except DeadlineExceeded:
+                raise
+            except Exception as error:  # pylint: disable=broad-except
+                self._selector.record_failure(endpoint)
+                if index == len(candidates) - 1:
+                    raise
+                LOGGER.warning("Request to %s failed, failing over: %s", endpoint, error)
+                continue
+
+            self._selector.record_success(endpoint, time.monotonic() - start)
+            return response
+
+        raise DeadlineExceeded(f"No endpoint left for {method} {url}")
+
+
+HostLimits = collections.namedtuple('HostLimits', ['rate', 'burst', 'concurrency'])
+"""
+Requests per second, bucket size and number of concurrent requests allowed
+per API host. Zero disables the respective limit.
+"""
+
+
+class HostLimiter:
+    """
+    Token bucket and concurrency cap for the requests to one API host.
+
+    The limiter state is shared by all clients talking to the host, while
+    the limits are passed by the caller. Hence, clients of modules with
+    different limits draw from the same bucket.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self._cond = threading.Condition()
+        self._tokens = None
+        self._updated = time.monotonic()
+        self._active = 0
+
+    def _delay(self, limits, now):
+        """
+        Return zero if a request may start now, the number of seconds until
+        a token is available or None if the concurrency cap is reached.
+        """
+        if limits.concurrency and self._active >= limits.concurrency:
+            return None
+        if not limits.rate:
+            return 0
+
+        burst = limits.burst or max(1, limits.rate)
+        if self._tokens is None:
+            self._tokens = burst
+        else:
+            self._tokens = min(burst, self._tokens + (now - self._updated) * limits.rate)
+        self._updated = now
+
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / limits.rate
+
+    def acquire(self, limits, timeout=None):
+        """
+        Wait until a request may be issued within limits and reserve it.
+        Return false if that is not possible within timeout seconds.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                delay = self._delay(limits, now)
+                if delay == 0:
+                    break
+                if end is not None:
+                    if now + (delay or 0) >= end:
+                        return False
+                    delay = min(end - now, delay or end - now)
+                self._cond.wait(delay)
+
+            if limits.rate:
+                self._tokens -= 1
+            self._active += 1
+            return True
+
+    def release(self):
+        """
+        Mark a request reserved by acquire() as finished.
+        """
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+
+class HostLimiters:
+    """
+    Keeps one process wide HostLimiter per API host.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def limiter(self, host):
+        """
+        Return the limiter of host.
+        """
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = HostLimiter(host)
+            return limiter
+
+
+HOST_LIMITERS = HostLimiters()
+"""
+Rate limiters of all API hosts, keyed by host:port.
+"""
+
+
+class LimitedSession:
+    """
+    Wraps the HTTP session of a proxmoxer client and throttles requests per
+    API host.
+
+    Requests wait for the HostLimiter of the host in the request url, but no
+    longer than until the scrape deadline.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, session, limits):
+        self._session = session
+        self._limits = limits
+
+    def __getattr__(self, item):
+        return getattr(self._session, item)
+
+    def request(self, method, url, data=None, params=None):
+        """
+        Issue a request once the limits of the API host allow for it.
+        """
+        limiter = HOST_LIMITERS.limiter(urlsplit(url).netloc)
+        if not limiter.acquire(self._limits, remaining_time()):
+            raise DeadlineExceeded(f"Scrape deadline exceeded waiting for {limiter.host}")
+
+        try:
+            return self._session.request(method, url, data=data, params=params)
+        finally:
+            limiter.release()
+
+
+class _CacheEntry:
+    """
+    A single memoized API response.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = False
+        self.value = None
+        self.error = None
+
+
+class ScrapeCache:
+    """
+    Memoizes PVE API responses for the duration of a single scrape.
+
+    Concurrent requests for the same key are coalesced, i.e., only the first
+    caller hits the API while the others wait for its result. Every caller
+    receives its own deep copy of the response, such that collectors are free
+    to modify the data they get. Failed requests are memoized as well, i.e.,
+    all callers receive the same exception.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def fetch(self, key, func):
+        """
+        Return a copy of the value stored under key. Call func to populate
+        the entry if it is missing.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _CacheEntry()
+
+        with entry.lock:
+            if not entry.done:
+                try:
+                    entry.value = func()
+                except Exception as error:
+                    entry.error = error
+                    raise
+                finally:
+                    entry.done = True
+
+        if entry.error is not None:
+            raise entry.error
+
+        return copy.deepcopy(entry.value)
+
+
+class CachedResource:
+    """
+    Wraps a proxmoxer resource and serves GET requests from a scrape cache.
+
+    Supports the subset of the proxmoxer resource interface used by the
+    collectors, i.e., attribute and call based path construction as well as
+    the get() method.
+    """
+
+    def __init__(self, resource, cache=None):
+        self._resource = resource
+        self._cache = ScrapeCache() if cache is None else cache
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+
+        return CachedResource(getattr(self._resource, item), self._cache)
+
+    def __call__(self, resource_id=None):
+        return CachedResource(self._resource(resource_id), self._cache)
+
+    def get(self, *args, **params):
+        """
+        Return the (possibly memoized) response of a GET request.
+        """
+        resource = self._resource(args)
+        # pylint: disable=protected-access
+        # Pinned responses of clients failing over may differ from the ones
+        # of other endpoints, hence they are cached separately.
+        pinned = _PINNED.get() and isinstance(resource._store['session'], FailoverSession)
+        key = (resource._store['base_url'], tuple(sorted(params.items())), pinned)
+        return self._cache.fetch(key, partial(resource.get, **params))
+
+
+def target_host(resource):
+    """
+    Return the host name of the scrape target of a (cached) proxmoxer
+    resource, regardless of the endpoint which answers its requests.
+    """
+    # pylint: disable=protected-access
+    if isinstance(resource, CachedResource):
+        resource = resource._resource
+    return urlsplit(resource._store['base_url']).hostname
+
+
+class _PooledClient:
+    """
+    A ProxmoxAPI client and the time it was last handed out.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, api):
+        self.api = api
+        self.last_used = time.monotonic()
+
+
+class ClientPool:
+    """
+    Keeps authenticated ProxmoxAPI clients around across scrapes.
+
+    Clients are keyed by (module, target). Reusing a client avoids a ticket
+    login on every scrape when using password authentication and keeps the
+    HTTP keep-alive connections of the underlying requests session open.
+
+    Proxmoxer renews a ticket on first use after an hour. Clients which were
+    idle for so long that their ticket is about to expire are replaced by a
+    fresh client instead.
+    """
+
+    def __init__(self, max_age=TICKET_LIFETIME - TICKET_RENEW_MARGIN):
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._key_locks = collections.defaultdict(threading.Lock)
+        self._clients = {}
+
+    def client(self, key, host, config, wrappers=()):
+        """
+        Return a pooled client for key. Create a new one if there is no
+        usable client in the pool.
+
+        The HTTP session of a new client is bounded by the scrape deadline
+        and then passed through every callable in wrappers, each of which
+        returns the session to use instead (e.g., a LimitedSession).
+        """
+        with self._lock:
+            key_lock = self._key_locks[key]
+
+        with key_lock:
+            with self._lock:
+                self._evict_expired()
+                pooled = self._clients.get(key)
+
+            if pooled is None:
+                api = ProxmoxAPI(host, **config)
+                # pylint: disable=protected-access
+                session = DeadlineSession(api._store['session'])
+                for wrapper in wrappers:
+                    session = wrapper(session)
+                api._store['session'] = session
+                pooled = _PooledClient(api)
+                with self._lock:
+                    self._clients[key] = pooled
+
+            pooled.last_used = time.monotonic()
+            return pooled.api
+
+    def discard(self, key, api):
+        """
+        Remove the client from the pool, e.g., after an authentication error.
+        """
+        with self._lock:
+            pooled = self._clients.get(key)
+            if pooled is not None and pooled.api is api:
+                del self._clients[key]
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [
+            key for key, pooled in self._clients.items()
+            if now - pooled.last_used >= self._max_age or
+            now - _ticket_birth_time(pooled.api, now) >= self._max_age
+        ]
+        for key in expired:
+            del self._clients[key]
+
+
+def _ticket_birth_time(api, default):
+    """
+    Return the time the auth ticket of api was issued. Return default for
+    clients not using ticket based authentication.
+    """
+    # pylint: disable=protected-access
+    auth = getattr(getattr(api, '_backend', None), 'auth', None)
+    return getattr(auth, 'birth_time', default)
+
+
+def is_auth_error(error):
+    """
+    Return true if the exception indicates that the client credentials or
+    the auth ticket were rejected.
+    """
+    if isinstance(error, AuthenticationError):
+        return True
+
+    return isinstance(error, ResourceException) and error.status_code == 401
+
+
+def is_connection_error(error):
+    """
+    Return true if the exception indicates that the API host could not be
+    reached, as opposed to an error response or a slow response. Connection
+    timeouts count as connection errors, read timeouts do not.
+    """
+    return isinstance(error, RequestsConnectionError)
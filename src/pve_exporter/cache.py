@@ -0,0 +1,82 @@
+"""
+In-process caches for the Proxmox VE prometheus collector.
+"""
+
+import collections
+import threading
+import time
+
+
+class TTLCache:
+    """
+    A thread safe mapping of bounded size with per lookup expiry.
+
+    Entries are evicted in least recently used order once the cache is full.
+    The time to live is supplied on lookup, such that entries of different
+    kinds can share one cache while expiring at different rates.
+    """
+
+    def __init__(self, maxsize, clock=time.monotonic):
+        self._maxsize = maxsize
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, ttl, default=None):
+        """
+        Return the value stored under key if it is younger than ttl seconds.
+        Return default otherwise.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            stored, value = entry
+            if self._clock() - stored >= ttl:
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Store value under key, evicting the least recently used entry if the
+        cache is full.
+        """
+        with self._lock:
+            self._entries[key] = (self._clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def scoped(self, scope, ttl):
+        """
+        Return a view on this cache with keys prefixed by scope and a fixed
+        time to live.
+        """
+        return CacheView(self, scope, ttl)
+
+
+class CacheView:
+    """
+    A view on a TTLCache with keys prefixed by a scope and a fixed ttl.
+    """
+
+    def __init__(self, cache, scope, ttl):
+        self._cache = cache
+        self._scope = scope
+        self._ttl = ttl
+
+    def get(self, key, default=None):
+        """
+        Return the unexpired value stored under key or default.
+        """
+        return self._cache.get(self._scope + key, self._ttl, default)
+
+    def put(self, key, value):
+        """
+        Store value under key.
+        """
+        self._cache.put(self._scope + key, value)
@@ -0,0 +1,146 @@
+"""
+Circuit breakers for unreachable targets of the Proxmox VE prometheus
+collector.
+"""
+
+import math
+import threading
+import time
+
+from prometheus_client import Gauge
+
+from pve_exporter.api import is_connection_error
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+CIRCUIT_STATE = Gauge(
+    'pve_exporter_target_circuit_state',
+    'State of the circuit breaker of a target (closed, open or half_open)',
+    ['module', 'target', 'state'],
+    multiprocess_mode='livemostrecent'
+)
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of scraping a target whose circuit breaker is open.
+    """
+
+    def __init__(self, target, retry_after):
+        super().__init__(
+            f"Target '{target}' is unreachable, not scraping it for another "
+            f"{math.ceil(retry_after)} seconds"
+        )
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Fails scrapes of a target fast after repeated connection failures.
+
+    The breaker opens after failures consecutive scrapes failed because the
+    target could not be reached. While open, scrapes raise CircuitOpen
+    without contacting the target. After cooldown seconds, a single probe
+    scrape is let through (half open). The breaker closes again if the target
+    responds, and opens for another cooldown otherwise.
+
+    Errors other than connection failures mean that the target is reachable
+    and therefore close the breaker.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, module, target, failures=3, cooldown=30):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self._labels = (module, target)
+        self._threshold = failures
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._state = None
+        self._set_state(CLOSED)
+
+    def _set_state(self, state):
+        if state == self._state:
+            return
+
+        self._state = state
+        for known in (CLOSED, OPEN, HALF_OPEN):
+            CIRCUIT_STATE.labels(*self._labels, known).set(1 if known == state else 0)
+
+    def _enter(self):
+        """
+        Raise CircuitOpen unless a scrape may proceed.
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return
+
+            retry_after = self._opened_at + self._cooldown - time.monotonic()
+            if self._state == HALF_OPEN or retry_after > 0:
+                raise CircuitOpen(self._labels[1], max(retry_after, 0))
+
+            self._set_state(HALF_OPEN)
+
+    def _leave(self, error=None):
+        """
+        Update the breaker after a scrape finished.
+        """
+        with self._lock:
+            if error is None or not is_connection_error(error):
+                self._failures = 0
+                self._set_state(CLOSED)
+                return
+
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self._threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def call(self, func):
+        """
+        Return the result of func unless the breaker is open.
+
+        BaseException is caught too (e.g., gevent.Timeout). Otherwise a
+        probe interrupted this way would leave the breaker half open forever.
+        """
+        self._enter()
+        try:
+            result = func()
+        except BaseException as error:
+            self._leave(error)
+            raise
+
+        self._leave()
+        return result
+
+
+class CircuitBreakers:
+    """
+    Keeps one CircuitBreaker per (module, target).
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def breaker(self, module, target, failures, cooldown):
+        """
+        Return the breaker of a target. Return None if failures is zero,
+        i.e., if the circuit breaker is disabled.
+        """
+        if failures <= 0:
+            return None
+
+        with self._lock:
+            breaker = self._breakers.get((module, target))
+            if breaker is None:
+                breaker = CircuitBreaker(module, target, failures, cooldown)
+                self._breakers[(module, target)] = breaker
+
+            return breaker
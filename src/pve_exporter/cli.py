@@ -6,16 +6,24 @@ from argparse import ArgumentParser, BooleanOptionalAction
 import os
 import pathlib
 import yaml
+from prometheus_client import multiprocess
 from pve_exporter import scrape_metrics
-from pve_exporter.http import start_http_server
+from pve_exporter.http import start_http_server, WebOptions
 from pve_exporter.config import config_from_yaml
 from pve_exporter.config import config_from_env
 from pve_exporter.collector import CollectorsOptions
 
 
-def main():
+def _child_exit(_, worker):
     """
-    Main entry point.
+    Gunicorn hook cleaning up metrics of a terminated worker process.
+    """
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def _argument_parser():
+    """
+    Return the command line argument parser.
     """
 
     parser = ArgumentParser()
@@ -48,7 +56,8 @@ def main():
 
     nodeflags = parser.add_argument_group('node collectors', description=(
         'node collectors are run if the url parameter node=1 is set and '
-        'skipped if the url parameter node=0 is set on a scrape url.'
+        'skipped if the url parameter node=0 is set on a scrape url. With '
+        'node=all they collect every online node of the cluster.'
     ))
     nodeflags.add_argument('--collector.config', dest='collector_config',
                            action=BooleanOptionalAction, default=True,
@@ -70,6 +79,9 @@ def main():
     scrapeflags.add_argument('--collector.target-metrics', dest='target_metrics_enabled',
                               action=BooleanOptionalAction, default=False,
                               help='Exposes duration of scrapes by target')
+    scrapeflags.add_argument('--collector.collector-metrics', dest='collector_metrics_enabled',
+                              action=BooleanOptionalAction, default=False,
+                              help='Exposes duration, API calls and success of collectors')
 
     parser.add_argument('--config.file', type=pathlib.Path,
                         dest="config_file", default='/etc/prometheus/pve.yml',
@@ -81,11 +93,55 @@ def main():
                             'Address on which to expose metrics and web server. '
                             '([::]:9221)'
                         ))
+    parser.add_argument('--web.workers', dest='web_workers',
+                        type=int, default=1,
+                        help=(
+                            'Number of gunicorn worker processes. Running more than '
+                            'one worker requires the PROMETHEUS_MULTIPROC_DIR '
+                            'environment variable. (1)'
+                        ))
+    parser.add_argument('--web.threads', dest='web_threads',
+                        type=int, default=2,
+                        help='Number of threads per gthread worker process. (2)')
+    parser.add_argument('--web.worker-class', dest='web_worker_class',
+                        choices=['gthread', 'gevent'], default='gthread',
+                        help=(
+                            'Type of gunicorn workers. The gevent worker class '
+                            'requires gevent. (gthread)'
+                        ))
+    parser.add_argument('--web.timeout', dest='web_timeout',
+                        type=int, default=30,
+                        help=(
+                            'Seconds after which gunicorn restarts a worker which '
+                            'is stuck on a request. (30)'
+                        ))
+    parser.add_argument('--web.compression-level', dest='web_compression_level',
+                        type=int, choices=range(0, 10), default=6, metavar='{0..9}',
+                        help=(
+                            'Level of gzip/deflate compression applied to responses if '
+                            'accepted by the client. 0 disables compression. (6)'
+                        ))
+    parser.add_argument('--web.compression-min-size', dest='web_compression_min_size',
+                        type=int, default=1024,
+                        help='Minimum response size in bytes to compress. (1024)')
+    parser.add_argument('--web.timeout-offset', dest='web_timeout_offset',
+                        type=float, default=0.5,
+                        help='Seconds subtracted from the scrape timeout announced by '
+                        'Prometheus in order to finish a scrape in time. (0.5)')
     parser.add_argument('--server.keyfile', dest='server_keyfile',
                         help='SSL key for server')
     parser.add_argument('--server.certfile', dest='server_certfile',
                         help='SSL certificate for server')
 
+    return parser
+
+
+def main():
+    """
+    Main entry point.
+    """
+
+    parser = _argument_parser()
     params = parser.parse_args()
 
     collectors = CollectorsOptions(
@@ -102,6 +158,12 @@ def main():
     )
     scrape_metrics.API_METRICS_ENABLED = params.api_metrics_enabled
     scrape_metrics.TARGET_METRICS_ENABLED = params.target_metrics_enabled
+    scrape_metrics.COLLECTOR_METRICS_ENABLED = params.collector_metrics_enabled
+    web_options = WebOptions(
+        compression_level=params.web_compression_level,
+        compression_min_size=params.web_compression_min_size,
+        timeout_offset=params.web_timeout_offset,
+    )
 
     # Load configuration.
     if 'PVE_USER' in os.environ:
@@ -112,13 +174,29 @@ def main():
 
     gunicorn_options = {
         'bind': f'{params.web_listen_address}',
-        'threads': 2,
+        'workers': params.web_workers,
+        'threads': params.web_threads,
+        'worker_class': params.web_worker_class,
+        'timeout': params.web_timeout,
         'keyfile': params.server_keyfile,
         'certfile': params.server_certfile,
         'control_socket_disable': True,
     }
 
-    if config.valid:
-        start_http_server(config, gunicorn_options, collectors)
-    else:
+    # Metrics of multiple worker processes need to be aggregated using the
+    # prometheus_client multiprocess mode.
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        for path in pathlib.Path(multiproc_dir).glob('*.db'):
+            path.unlink()
+        gunicorn_options['child_exit'] = _child_exit
+    elif params.web_workers > 1:
+        parser.error(
+            '--web.workers greater than 1 requires the PROMETHEUS_MULTIPROC_DIR '
+            'environment variable pointing to an empty writable directory.'
+        )
+
+    if not config.valid:
         parser.error(str(config))
+
+    start_http_server(config, gunicorn_options, collectors, web_options)
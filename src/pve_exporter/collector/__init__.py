@@ -3,10 +3,30 @@ Prometheus collecters for Proxmox VE cluster.
 """
 
 import collections
-from proxmoxer import ProxmoxAPI
+import itertools
+import logging
+import threading
+import time
+from functools import partial
 
-from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.core import GaugeMetricFamily
 
+from pve_exporter.api import (
+    SCRAPE_DEADLINE,
+    CachedResource,
+    ClientPool,
+    DeadlineExceeded,
+    EndpointSelectors,
+    FailoverSession,
+    HostLimits,
+    LimitedSession,
+    is_auth_error,
+    is_connection_error,
+    remaining_time
+)
+from pve_exporter.cache import TTLCache
+from pve_exporter.concurrency import bounded_map
+from pve_exporter.config import api_settings, exporter_settings
 from pve_exporter.collector.cluster import (
     StatusCollector,
     ClusterResourcesCollector,
@@ -35,32 +55,278 @@ CollectorsOptions = collections.namedtuple('CollectorsOptions', [
     'qdevice'
 ])
 
+CollectorResult = collections.namedtuple('CollectorResult', [
+    'collector',
+    'families',
+    'error',
+    'stale_age',
+])
+
+
+LOGGER = logging.getLogger(__name__)
+
+CLIENTS = ClientPool()
+"""
+Authenticated API clients shared across scrapes.
+"""
+
+ENDPOINTS = EndpointSelectors()
+"""
+Latency and health of the API endpoints of every (module, target) with
+alternative endpoints configured.
+"""
+
+GUEST_CONFIGS = TTLCache(maxsize=65536)
+"""
+Guest config values keyed by (target, node, type, vmid).
+"""
+
+COLLECTOR_RESULTS = TTLCache(maxsize=1024)
+"""
+Metric families of collectors with a ttl keyed by (module, target, cluster,
+node, collector).
+"""
+
+LAST_GOOD_RESULTS = TTLCache(maxsize=1024)
+"""
+(monotonic time, metric families) of the last successful run of a collector
+keyed by (module, target, cluster, node, collector). Only populated if the
+stale_grace setting is enabled.
+"""
+
+
+class CollectedFamilies:
+    """
+    Collector returning metric families which were collected beforehand.
+    """
 
-def collect_pve(config, host, cluster, node, options: CollectorsOptions):
-    """Scrape a host and return prometheus text format for it"""
+    # pylint: disable=too-few-public-methods
 
-    pve = ProxmoxAPI(host, **config)
+    def __init__(self, families):
+        self._families = families
 
-    registry = CollectorRegistry()
+    def collect(self):  # pylint: disable=missing-docstring
+        return iter(self._families)
+
+
+def _select_collectors(pve, host, cluster, node, options: CollectorsOptions, settings):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """Return (name, collector) pairs enabled for a scrape in output order"""
+
+    all_nodes = node == 'all'
+    collectors = []
     if cluster and options.status:
-        registry.register(StatusCollector(pve))
+        collectors.append(('status', StatusCollector(pve)))
     if cluster and options.resources:
-        registry.register(ClusterResourcesCollector(pve))
+        collectors.append(('resources', ClusterResourcesCollector(
+            pve,
+            settings['state_series'] == 'active'
+        )))
     if cluster and options.node:
-        registry.register(ClusterNodeCollector(pve))
+        collectors.append(('node', ClusterNodeCollector(pve)))
     if cluster and options.cluster:
-        registry.register(ClusterInfoCollector(pve))
+        collectors.append(('cluster', ClusterInfoCollector(pve)))
     if cluster and options.version:
-        registry.register(VersionCollector(pve))
+        collectors.append(('version', VersionCollector(pve)))
     if cluster and options.backup_info:
-        registry.register(BackupInfoCollector(pve))
+        collectors.append(('backup_info', BackupInfoCollector(pve)))
     if cluster and options.qdevice:
-        registry.register(QDeviceCollector(pve))
+        collectors.append(('qdevice', QDeviceCollector(pve)))
     if node and options.subscription:
-        registry.register(SubscriptionCollector(pve))
+        collectors.append(('subscription', SubscriptionCollector(
+            pve,
+            settings['request_concurrency'],
+            all_nodes
+        )))
     if node and options.config:
-        registry.register(NodeConfigCollector(pve))
+        config_cache = None
+        if settings['config_cache_ttl'] > 0:
+            config_cache = GUEST_CONFIGS.scoped((host,), settings['config_cache_ttl'])
+        collectors.append(('config', NodeConfigCollector(
+            pve,
+            settings['request_concurrency'],
+            config_cache,
+            all_nodes
+        )))
     if node and options.replication:
-        registry.register(NodeReplicationCollector(pve))
+        collectors.append(('replication', NodeReplicationCollector(
+            pve,
+            settings['request_concurrency'],
+            settings['replication_status_from_list'],
+            all_nodes
+        )))
+
+    return collectors
+
+
+def _session_wrappers(settings, selector):
+    """
+    Return the wrappers applied to the HTTP session of a new API client,
+    innermost first.
+    """
+    wrappers = []
+    limits = HostLimits(
+        settings['host_rate_limit'],
+        settings['host_rate_burst'],
+        settings['host_concurrency']
+    )
+    if any(limits):
+        wrappers.append(partial(LimitedSession, limits=limits))
+    if selector is not None:
+        wrappers.append(partial(FailoverSession, selector=selector))
+
+    return wrappers
+
+
+def _run_collector(scope, ttls, named_collector):
+    """
+    Return the metric families of a collector and whether or not they were
+    served from the cache. The cache is used if a ttl is configured for the
+    collector.
+    """
+    name, collector = named_collector
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded(f"Scrape deadline exceeded before collector {name}")
+
+    ttl = ttls.get(name, 0)
+    if ttl <= 0:
+        return list(collector.collect()), False
+
+    families = COLLECTOR_RESULTS.get(scope + (name,), ttl)
+    if families is not None:
+        return families, True
+
+    families = list(collector.collect())
+    COLLECTOR_RESULTS.put(scope + (name,), families)
+    return families, False
+
+
+def _is_unreachable(error):
+    """
+    Return true if the error indicates that the target is unreachable, i.e.,
+    a connection error which occurred before the scrape deadline.
+    """
+    remaining = remaining_time()
+    return is_connection_error(error) and (remaining is None or remaining > 0)
+
+
+def _run_collector_isolated(scope, settings, abort, named_collector):
+    """
+    Return the CollectorResult of a collector.
+
+    Errors other than authentication and connection errors are caught, such
+    that a failing collector does not fail the whole scrape. If the
+    stale_grace setting is enabled, the families of the last successful run
+    of a failed collector are returned instead, unless they are older than
+    stale_grace seconds.
+
+    Authentication and connection errors are raised and set the abort event,
+    such that collectors which did not start yet are skipped instead of
+    contacting an unreachable target again.
+    """
+    name = named_collector[0]
+    grace = settings['stale_grace']
+    if abort.is_set():
+        return CollectorResult(name, [], None, None)
+
+    try:
+        families, cached = _run_collector(scope, settings['collector_ttl'], named_collector)
+    except Exception as error:  # pylint: disable=broad-except
+        if is_auth_error(error) or _is_unreachable(error):
+            abort.set()
+            raise
+
+        LOGGER.warning("Collector %s failed for %s: %s", name, scope[1], error)
+        last_good = LAST_GOOD_RESULTS.get(scope + (name,), grace) if grace > 0 else None
+        if last_good is None:
+            return CollectorResult(name, [], error, None)
+
+        collected_at, families = last_good
+        return CollectorResult(name, families, error, time.monotonic() - collected_at)
+
+    if grace > 0 and not cached:
+        LAST_GOOD_RESULTS.put(scope + (name,), (time.monotonic(), families))
+
+    return CollectorResult(name, families, None, None)
+
+
+def _merge_results(results):
+    """
+    Return the metric families of all collector results followed by a
+    staleness marker for collectors served from an earlier run.
+
+    Raise the first error if every collector failed and there are no
+    families to serve, not even from an earlier run.
+    """
+    families = list(itertools.chain.from_iterable(result.families for result in results))
+    if results and not families and all(result.error is not None for result in results):
+        raise results[0].error
+
+    stale = [result for result in results if result.stale_age is not None]
+    if stale:
+        marker = GaugeMetricFamily(
+            'pve_exporter_collector_stale_seconds',
+            'Age of metrics served from an earlier scrape because the collector failed',
+            labels=['collector'])
+        for result in stale:
+            marker.add_metric([result.collector], result.stale_age)
+        families.append(marker)
+
+    return families
+
+
+def collect_pve(config, host, cluster, node, options: CollectorsOptions,
+                module='default', deadline=None):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """Scrape a host and return the collected metric families
+
+    Node collectors query the node the API is served by if node is true, resp.
+    every online node of the cluster if node is 'all'.
+
+    If a deadline (in terms of time.monotonic()) is given, API requests are
+    bounded by it. Metrics of collectors which fail or do not finish in time
+    are left out of the result (or served from an earlier scrape, see
+    _run_collector_isolated). The scrape fails if the target is unreachable
+    or if all collectors which ran failed.
+    """
+
+    settings = exporter_settings(config)
+    client_key = (module, host)
+    selector = ENDPOINTS.selector(client_key, host, settings['endpoints'])
+    api = CLIENTS.client(
+        client_key,
+        host,
+        api_settings(config),
+        _session_wrappers(settings, selector)
+    )
+
+    # Collectors share one response cache per scrape. Hence, API endpoints
+    # used by multiple collectors (e.g., cluster/status) are only fetched once.
+    pve = CachedResource(api)
+
+    # Collectors are independent of each other and may run concurrently.
+    # Their results are returned in the original order, such that the
+    # output does not depend on the order in which collectors finish.
+    token = SCRAPE_DEADLINE.set(deadline)
+    try:
+        if selector is not None and selector.discovery_due():
+            selector.discover(pve.cluster.status.get())
+        results = bounded_map(
+            partial(
+                _run_collector_isolated,
+                (module, host, cluster, node),
+                settings,
+                threading.Event()
+            ),
+            _select_collectors(pve, host, cluster, node, options, settings),
+            settings['collector_concurrency']
+        )
+    except Exception as error:
+        if is_auth_error(error):
+            CLIENTS.discard(client_key, api)
+        raise
+    finally:
+        SCRAPE_DEADLINE.reset(token)
 
-    return generate_latest(registry)
+    return CollectedFamilies(_merge_results(results))
@@ -4,9 +4,10 @@ Prometheus collecters for Proxmox VE cluster.
 # pylint: disable=too-few-public-methods
 
 import itertools
+import time
 import typing
 
-from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, Sample
 from proxmoxer import ResourceException
 
 
@@ -217,6 +218,26 @@ class QDeviceCollector:
         yield info_metric
 
 
+def _add_state_samples(family, resource_id, states, current):
+    """
+    Add one sample per state to a state set family labeled by id and state.
+    The sample of the current state is true, all others are false.
+
+    If the family only reports the active state, a single sample is added
+    for the current state, or none at all if it is not one of states.
+    """
+    name = family.name
+    if family.active_only:
+        if current in states:
+            family.samples.append(Sample(name, {'id': resource_id, 'state': current}, 1))
+        return
+
+    family.samples.extend(
+        Sample(name, {'id': resource_id, 'state': state}, current == state)
+        for state in states
+    )
+
+
 class HighAvailabilityStateMetric(GaugeMetricFamily):
     """
     A single gauge representing PVE ha state.
@@ -244,12 +265,13 @@ class HighAvailabilityStateMetric(GaugeMetricFamily):
         'node': NODE_STATES,
     }
 
-    def __init__(self):
+    def __init__(self, active_only=False):
         super().__init__(
             'pve_ha_state',
             'HA service status (for HA managed VMs).',
             labels=['id', 'state']
         )
+        self.active_only = active_only
 
     def add_metric_from_resource(self, resource: dict):
         """Inspect resource and add suitable metric- to the metric family.
@@ -257,11 +279,9 @@ class HighAvailabilityStateMetric(GaugeMetricFamily):
         Args:
           resource: A PVE cluster resource
         """
-        restype = resource['type']
-        if restype in self.STATES:
-            for state in self.STATES[restype]:
-                value = resource.get('hastate', None) == state
-                self.add_metric([resource['id'], state], value)
+        states = self.STATES.get(resource['type'])
+        if states:
+            _add_state_samples(self, resource['id'], states, resource.get('hastate', None))
 
 
 class LockStateMetric(GaugeMetricFamily):
@@ -286,12 +306,13 @@ class LockStateMetric(GaugeMetricFamily):
         'lxc': GUEST_STATES,
     }
 
-    def __init__(self):
+    def __init__(self, active_only=False):
         super().__init__(
             'pve_lock_state',
             "The guest's current config lock (for types 'qemu' and 'lxc')",
             labels=['id', 'state']
         )
+        self.active_only = active_only
 
     def add_metric_from_resource(self, resource: dict):
         """Inspect resource and add suitable metric- to the metric family.
@@ -299,21 +320,54 @@ class LockStateMetric(GaugeMetricFamily):
         Args:
           resource: A PVE cluster resource
         """
-        restype = resource['type']
-        if restype in self.STATES:
-            for state in self.STATES[restype]:
-                value = resource.get('lock', None) == state
-                self.add_metric([resource['id'], state], value)
+        states = self.STATES.get(resource['type'])
+        if states:
+            _add_state_samples(self, resource['id'], states, resource.get('lock', None))
+
+
+def _resource_sample_index(gauges, counters):
+    """
+    Map resource keys to (append, sample name, created sample name) tuples of
+    the families a resource key contributes to.
+    """
+    index = {}
+    for key, family in gauges.items():
+        index.setdefault(key, []).append((family.samples.append, family.name, None))
+    for key, family in counters.items():
+        index.setdefault(key, []).append(
+            (family.samples.append, family.name + '_total', family.name + '_created')
+        )
+
+    return index
+
+
+def _add_resource_samples(index, resource, created):
+    """
+    Add the samples of a cluster resource in a single pass over its items.
+
+    Samples of a resource share one label dict. Families are rendered
+    read-only, hence it is never modified afterwards.
+    """
+    labels = {'id': resource['id']}
+    for key, value in resource.items():
+        for append, name, created_name in index.get(key, ()):
+            append(Sample(name, labels, value))
+            if created_name and created is not None:
+                append(Sample(created_name, labels, created))
 
 
 class ClusterResourcesCollector:
     """
     Collects Proxmox VE cluster resources information, i.e. memory, storage, cpu
     usage for cluster nodes and guests.
+
+    If active_states is true, the HA and lock state sets only report the
+    current state of every resource instead of one series per known state.
     """
 
-    def __init__(self, pve):
+    def __init__(self, pve, active_states=False):
         self._pve = pve
+        self._active_states = active_states
 
     def collect(self):  # pylint: disable=missing-docstring
         metrics = {
@@ -424,8 +478,8 @@ class ClusterResourcesCollector:
                 labels=['id']),
         }
 
-        ha_metric = HighAvailabilityStateMetric()
-        lock_metric = LockStateMetric()
+        ha_metric = HighAvailabilityStateMetric(self._active_states)
+        lock_metric = LockStateMetric(self._active_states)
 
         info_metrics = {
             'guest': GaugeMetricFamily(
@@ -454,6 +508,9 @@ class ClusterResourcesCollector:
             },
         }
 
+        index = _resource_sample_index(metrics, counter_metrics)
+
+        now = time.time()
         for resource in self._pve.cluster.resources.get():
             restype = resource['type']
 
@@ -464,12 +521,11 @@ class ClusterResourcesCollector:
             ha_metric.add_metric_from_resource(resource)
             lock_metric.add_metric_from_resource(resource)
 
-            label_values = [resource['id']]
-            for key, metric_value in resource.items():
-                if key in metrics:
-                    metrics[key].add_metric(label_values, metric_value)
-                if key in counter_metrics:
-                    counter_metrics[key].add_metric(label_values, metric_value)
+            # Counters are reset when a guest is started. Hence, their created
+            # timestamp is the start time of the guest.
+            created = now - resource['uptime'] if resource.get('uptime') else None
+
+            _add_resource_samples(index, resource, created)
 
         return itertools.chain(
             metrics.values(),
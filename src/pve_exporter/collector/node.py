@@ -4,9 +4,93 @@ Prometheus collecters for Proxmox VE cluster.
 # pylint: disable=too-few-public-methods
 
 import itertools
+import logging
+import socket
 from datetime import datetime
+from functools import partial
 
 from prometheus_client.core import GaugeMetricFamily
+from proxmoxer import ResourceException
+
+from pve_exporter.api import is_auth_error, is_connection_error, pinned_to_target, target_host
+from pve_exporter.concurrency import bounded_map
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _target_node(status, host):
+    """
+    Return the name of the node in a cluster status whose address is the one
+    of the target host.
+    """
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except OSError:
+        addresses = {host}
+
+    for entry in status:
+        if entry['type'] == 'node' and entry.get('ip') in addresses:
+            return entry['name']
+
+    raise LookupError(f"No node of the cluster has the address of target {host}")
+
+
+def scraped_nodes(pve, all_nodes=False):
+    """
+    Return the names of the nodes to collect, i.e., the node the API is
+    queried on or every online node of the cluster if all_nodes is true.
+
+    The local node is looked up on the scrape target itself, even if other
+    endpoints of the cluster answer the remaining requests. If the target
+    cannot be reached, the node whose address matches the target is looked
+    up in the cluster status of another endpoint instead.
+    """
+    if all_nodes:
+        status = pve.cluster.status.get()
+        return [entry['name'] for entry in status
+                if entry['type'] == 'node' and entry['online']]
+
+    try:
+        with pinned_to_target():
+            status = pve.cluster.status.get()
+    except Exception as error:  # pylint: disable=broad-except
+        if not is_connection_error(error):
+            raise
+
+        # Without other endpoints this is the same request, so the
+        # memoized connection error is raised again.
+        host = target_host(pve)
+        node = _target_node(pve.cluster.status.get(), host)
+        LOGGER.warning("Target %s is unreachable, collecting node %s via other endpoints: %s",
+                       host, node, error)
+        return [node]
+
+    for entry in status:
+        if entry['type'] == 'node' and entry['local']:
+            return [entry['name']]
+
+    return []
+
+
+def map_nodes(func, nodes, max_workers, all_nodes=False):
+    """
+    Apply func to every node using at most max_workers threads and return
+    (node, result) pairs in the order of nodes.
+
+    When collecting all nodes, nodes which fail with an API error are logged
+    and left out, such that a single unreachable node does not fail the
+    whole scrape.
+    """
+    def _call(node):
+        try:
+            return node, func(node)
+        except ResourceException as error:
+            if is_auth_error(error) or not all_nodes:
+                raise
+            LOGGER.warning("Skipping node %s: %s", node, error)
+            return None
+
+    return [result for result in bounded_map(_call, nodes, max_workers) if result is not None]
 
 
 class NodeConfigCollector:
@@ -14,13 +98,22 @@ class NodeConfigCollector:
     Collects Proxmox VE VM information directly from config, i.e. boot, name, onboot, etc.
     For manual test: "pvesh get /nodes/<node>/<type>/<vmid>/config"
 
+    If a cache is given, config values are kept there and only fetched again
+    for guests which showed up in the guest list since or whose cache entry
+    expired. If all_nodes is true, guests of every online node are collected.
+
     # HELP pve_onboot_status Proxmox vm config onboot value
     # TYPE pve_onboot_status gauge
     pve_onboot_status{id="qemu/113",node="XXXX",type="qemu"} 1.0
     """
 
-    def __init__(self, pve):
+    CONFIG_KEYS = ['onboot']
+
+    def __init__(self, pve, max_workers=1, cache=None, all_nodes=False):
         self._pve = pve
+        self._max_workers = max_workers
+        self._cache = cache
+        self._all_nodes = all_nodes
 
     def collect(self):  # pylint: disable=missing-docstring
         metrics = {
@@ -30,43 +123,87 @@ class NodeConfigCollector:
                 labels=['id', 'node', 'type']),
         }
 
-        node = None
-        for entry in self._pve.cluster.status.get():
-            if entry['type'] == 'node' and entry['local']:
-                node = entry['name']
-                break
-
-        # Scrape qemu config
-        vmtype = 'qemu'
-        for vmdata in self._pve.nodes(node).qemu.get():
-            config = self._pve.nodes(node).qemu(
-                vmdata['vmid']).config.get().items()
-            for key, metric_value in config:
-                label_values = [f"{vmtype}/{vmdata['vmid']}", node, vmtype]
-                if key in metrics:
-                    metrics[key].add_metric(label_values, metric_value)
+        nodes = scraped_nodes(self._pve, self._all_nodes)
+        guests = [
+            (node, vmtype, vmid)
+            for node, node_guests in map_nodes(
+                self._guests, nodes, self._max_workers, self._all_nodes
+            )
+            for vmtype, vmid in node_guests
+        ]
+
+        # Fetch guest configs concurrently, one API call per guest.
+        configs = bounded_map(self._config, guests, self._max_workers)
 
-        # Scrape LXC config
-        vmtype = 'lxc'
-        for vmdata in self._pve.nodes(node).lxc.get():
-            config = self._pve.nodes(node).lxc(
-                vmdata['vmid']).config.get().items()
-            for key, metric_value in config:
-                label_values = [f"{vmtype}/{vmdata['vmid']}", node, vmtype]
+        for (node, vmtype, vmid), config in zip(guests, configs):
+            if config is None:
+                continue
+
+            label_values = [f"{vmtype}/{vmid}", node, vmtype]
+            for key, metric_value in config.items():
                 if key in metrics:
                     metrics[key].add_metric(label_values, metric_value)
 
         return metrics.values()
 
+    def _guests(self, node):
+        """
+        Return (type, vmid) tuples of the guests on a node.
+        """
+        guests = [('qemu', vmdata['vmid']) for vmdata in self._pve.nodes(node).qemu.get()]
+        guests += [('lxc', vmdata['vmid']) for vmdata in self._pve.nodes(node).lxc.get()]
+        return guests
+
+    def _config(self, guest):
+        """
+        Return the relevant config values of a (node, type, vmid) guest,
+        either from the cache or from the API.
+        """
+        if self._cache is None:
+            return self._fetch_config(guest)
+
+        config = self._cache.get(guest)
+        if config is None:
+            config = self._fetch_config(guest)
+            if config is not None:
+                self._cache.put(guest, config)
+
+        return config
+
+    def _fetch_config(self, guest):
+        """
+        Return the relevant config values of a guest or None if they cannot
+        be retrieved, e.g., because the guest was removed or migrated in the
+        meantime.
+        """
+        node, vmtype, vmid = guest
+        try:
+            config = getattr(self._pve.nodes(node), vmtype)(vmid).config.get()
+        except ResourceException as error:
+            if is_auth_error(error):
+                raise
+            LOGGER.warning("Skipping config of %s/%s on node %s: %s", vmtype, vmid, node, error)
+            return None
+
+        return {key: value for key, value in config.items() if key in self.CONFIG_KEYS}
+
 class NodeReplicationCollector:
     """
     Collects Proxmox VE Replication information directly from status, i.e. replication duration,
     last_sync, last_try, next_sync, fail_count.
     For manual test: "pvesh get /nodes/<node>/replication/<id>/status"
+
+    The replication job list returned by the API already contains the status
+    fields of each job. If status_from_list is set, those are used instead
+    of requesting the status of every job separately. If all_nodes is true,
+    jobs of every online node are collected.
     """
 
-    def __init__(self, pve):
+    def __init__(self, pve, max_workers=1, status_from_list=False, all_nodes=False):
         self._pve = pve
+        self._max_workers = max_workers
+        self._status_from_list = status_from_list
+        self._all_nodes = all_nodes
 
     def collect(self): # pylint: disable=missing-docstring
 
@@ -100,13 +237,24 @@ class NodeReplicationCollector:
                 labels=['id']),
         }
 
-        node = None
-        for entry in self._pve.cluster.status.get():
-            if entry['type'] == 'node' and entry['local']:
-                node = entry['name']
-                break
+        nodes = scraped_nodes(self._pve, self._all_nodes)
+        jobs = {}
+        for node, node_jobs in map_nodes(
+            lambda node: self._pve.nodes(node).replication.get(),
+            nodes,
+            self._max_workers,
+            self._all_nodes
+        ):
+            for jobdata in node_jobs:
+                jobs.setdefault(jobdata['id'], (node, jobdata))
+
+        statuses = bounded_map(
+            partial(self._job_status, metrics.keys()),
+            jobs.values(),
+            self._max_workers
+        )
 
-        for jobdata in self._pve.nodes(node).replication.get():
+        for (_, jobdata), status in zip(jobs.values(), statuses):
             # Add info metric
             label_values = [
                 str(jobdata['id']),
@@ -119,20 +267,32 @@ class NodeReplicationCollector:
 
             # Add metrics
             label_values = [str(jobdata['id'])]
-            status = self._pve.nodes(node).replication(jobdata['id']).status.get()
             for key, metric_value in status.items():
                 if key in metrics:
                     metrics[key].add_metric(label_values, metric_value)
 
         return itertools.chain(metrics.values(), info_metrics.values())
 
+    def _job_status(self, status_keys, node_job):
+        """
+        Return the status of a (node, job) replication job.
+        """
+        node, jobdata = node_job
+        if self._status_from_list and any(key in jobdata for key in status_keys):
+            return jobdata
+
+        return self._pve.nodes(node).replication(jobdata['id']).status.get()
+
 class SubscriptionCollector:
     """
     Collects Proxmox VE subscription information (node, subscription level, status, next due date).
+    If all_nodes is true, subscriptions of every online node are collected.
     """
 
-    def __init__(self, pve):
+    def __init__(self, pve, max_workers=1, all_nodes=False):
         self._pve = pve
+        self._max_workers = max_workers
+        self._all_nodes = all_nodes
 
     def collect(self):  # pylint: disable=missing-docstring
         info_metric = GaugeMetricFamily(
@@ -154,36 +314,35 @@ class SubscriptionCollector:
             labels=["id"],
         )
 
-        node = None
-        for entry in self._pve.cluster.status.get():
-            if entry['type'] == 'node' and entry['local']:
-                node = entry['name']
-                break
-
-        subscription = self._pve.nodes(node).subscription.get()
-
-        level = subscription.get("level", "unknown")
-        status = subscription.get("status", "unknown")
-
-        info_metric.add_metric(
-            [f"node/{node}", level],
-            1,
-        )
-
-        for possible_status in possible_statuses:
-            value = 1 if status == possible_status else 0
-            status_metric.add_metric(
-                [f"node/{node}", possible_status],
-                value,
+        nodes = scraped_nodes(self._pve, self._all_nodes)
+        for node, subscription in map_nodes(
+            lambda node: self._pve.nodes(node).subscription.get(),
+            nodes,
+            self._max_workers,
+            self._all_nodes
+        ):
+            level = subscription.get("level", "unknown")
+            status = subscription.get("status", "unknown")
+
+            info_metric.add_metric(
+                [f"node/{node}", level],
+                1,
             )
 
-        next_due_date = subscription.get("nextduedate")
-        if next_due_date:
-            timestamp = datetime.strptime(next_due_date, "%Y-%m-%d").timestamp()
-            next_due_metric.add_metric(
-                [f"node/{node}"],
-                timestamp,
-            )
+            for possible_status in possible_statuses:
+                value = 1 if status == possible_status else 0
+                status_metric.add_metric(
+                    [f"node/{node}", possible_status],
+                    value,
+                )
+
+            next_due_date = subscription.get("nextduedate")
+            if next_due_date:
+                timestamp = datetime.strptime(next_due_date, "%Y-%m-%d").timestamp()
+                next_due_metric.add_metric(
+                    [f"node/{node}"],
+                    timestamp,
+                )
 
         yield info_metric
         yield status_metric
@@ -0,0 +1,73 @@
+"""
+Concurrency helpers for the Proxmox VE prometheus collector.
+"""
+
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def bounded_map(func, items, max_workers):
+    """
+    Apply func to every item using at most max_workers threads and return
+    the results in the order of items. Runs in the calling thread if
+    max_workers is 1 or less.
+
+    Worker threads run func in a copy of the calling thread's context, hence
+    context variables set by the caller are visible to func.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, func, item)
+            for item in items
+        ]
+        return [future.result() for future in futures]
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key.
+
+    The first caller for a key runs the function. Callers arriving while the
+    call is still in flight wait for it and receive the same result, resp.
+    the same exception.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, timeout=None):
+        """
+        Return the result of func, shared with concurrent calls for key.
+
+        Callers joining a call in flight wait at most timeout seconds for its
+        result and raise concurrent.futures.TimeoutError afterwards. The
+        caller running func is not bounded by timeout.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result(timeout)
+
+        try:
+            result = func()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -4,6 +4,46 @@ Config module for Proxmox VE prometheus collector.
 
 from collections.abc import Mapping
 
+EXPORTER_DEFAULTS = {
+    'collector_concurrency': 1,
+    'request_concurrency': 1,
+    'config_cache_ttl': 0,
+    'replication_status_from_list': False,
+    'precollect_targets': (),
+    'precollect_interval': 30,
+    'precollect_max_age': 0,
+    'collector_ttl': {},
+    'state_series': 'full',
+    'endpoints': (),
+    'host_rate_limit': 0,
+    'host_rate_burst': 0,
+    'host_concurrency': 0,
+    'circuit_failures': 3,
+    'circuit_cooldown': 30,
+    'stale_grace': 0,
+}
+"""
+Module config keys consumed by the exporter itself and their default values.
+All other keys of a module are passed on to proxmoxer.ProxmoxAPI().
+"""
+
+
+def api_settings(module):
+    """
+    Given a module config return the keyword arguments for ProxmoxAPI().
+    """
+    return {key: value for key, value in module.items() if key not in EXPORTER_DEFAULTS}
+
+
+def exporter_settings(module):
+    """
+    Given a module config return the exporter settings with defaults applied.
+    """
+    settings = dict(EXPORTER_DEFAULTS)
+    settings.update({key: value for key, value in module.items() if key in EXPORTER_DEFAULTS})
+    return settings
+
+
 def config_from_yaml(yaml):
     """
     Given a dictionary parsed from a yaml file return a config object.
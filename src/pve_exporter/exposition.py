@@ -0,0 +1,187 @@
+"""
+Exposition format negotiation for Proxmox VE prometheus collector.
+"""
+
+import re
+
+from prometheus_client.exposition import choose_encoder as _choose_encoder
+from prometheus_client.metrics_core import Metric
+from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST as OPENMETRICS_TYPE
+from prometheus_client.openmetrics.exposition import ALLOWUTF8, UNDERSCORES
+from prometheus_client.utils import floatToGoString
+
+from pve_exporter.collector import CollectedFamilies
+
+OPENMETRICS_EOF = b'# EOF\n'
+"""
+Marker terminating an OpenMetrics exposition.
+"""
+
+_METRIC_NAME_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+_LABEL_NAME_RE = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+
+def _without_created(metrics):
+    """
+    Drop the created samples of counters.
+
+    Created timestamps are an OpenMetrics feature. The Prometheus text format
+    exposes them as separate gauges, which would add a new series for every
+    counter.
+    """
+    for metric in metrics:
+        yield _strip_created(metric)
+
+
+def _strip_created(metric):
+    """
+    Return the metric without created samples.
+    """
+    if metric.type != 'counter':
+        return metric
+
+    created_name = metric.name + '_created'
+    samples = [sample for sample in metric.samples if sample.name != created_name]
+    if len(samples) == len(metric.samples):
+        return metric
+
+    stripped = Metric(metric.name, metric.documentation, metric.type, metric.unit)
+    stripped.samples = samples
+    return stripped
+
+
+def _without_clashes(metrics):
+    """
+    Drop families clashing with the name of a counter.
+
+    OpenMetrics strips the _total suffix from counter family names. Hence,
+    the deprecated gauges (e.g., pve_network_transmit_bytes) share the name
+    of their counterparts (e.g., pve_network_transmit_bytes_total). Those
+    gauges are left out of OpenMetrics expositions.
+    """
+    metrics = list(metrics)
+    counters = {metric.name for metric in metrics if metric.type == 'counter'}
+    for metric in metrics:
+        if metric.type == 'counter' or metric.name not in counters:
+            yield metric
+
+
+def _render_text(metric, label_strings):
+    """
+    Render a gauge or counter family in the Prometheus text format.
+
+    Rendered label sets are memoized in label_strings by the identity of the
+    label dict. Hence, label dicts shared by the samples of many families
+    (e.g., the id label of cluster resources) are only escaped once. Returns
+    None for families which must be rendered by prometheus_client instead.
+    """
+    if metric.type == 'counter':
+        name = metric.name + '_total'
+    elif metric.type == 'gauge':
+        name = metric.name
+    else:
+        return None
+
+    if not _METRIC_NAME_RE.match(name):
+        return None
+
+    documentation = metric.documentation.replace('\\', r'\\').replace('\n', r'\n')
+    lines = [f'# HELP {name} {documentation}\n# TYPE {name} {metric.type}\n']
+    for sample in metric.samples:
+        if sample.name != name or sample.timestamp is not None:
+            return None
+
+        labels = _label_string(sample.labels, label_strings)
+        if labels is None:
+            return None
+
+        lines.append(f'{name}{labels} {floatToGoString(sample.value)}\n')
+
+    return ''.join(lines).encode('utf-8')
+
+
+def _label_string(labels, label_strings):
+    """
+    Return the rendered label set of a sample, or None if it contains label
+    names or values the text renderer does not handle.
+    """
+    if not labels:
+        return ''
+
+    entry = label_strings.get(id(labels))
+    if entry is not None and entry[0] is labels:
+        return entry[1]
+
+    pairs = []
+    for key, value in sorted(labels.items()):
+        if not _LABEL_NAME_RE.match(key) or key.startswith('__') or not isinstance(value, str):
+            return None
+        value = value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+        pairs.append(f'{key}="{value}"')
+
+    rendered = '{' + ','.join(pairs) + '}'
+    # Keep a reference to the label dict, such that its id is not reused.
+    label_strings[id(labels)] = (labels, rendered)
+    return rendered
+
+
+class Encoder:
+    """
+    Renders the metric families of a collector in a given exposition format.
+
+    Calling the encoder returns the complete exposition. Use stream() in
+    order to render it family by family instead.
+
+    If direct is true, gauges and counters are rendered by _render_text
+    instead of prometheus_client. This is only valid for the Prometheus text
+    format with legacy metric and label names left unescaped.
+    """
+
+    def __init__(self, encode, select, openmetrics, direct=False):
+        self._encode = encode
+        self._select = select
+        self._openmetrics = openmetrics
+        self._direct = direct
+
+    def __call__(self, collector):
+        return b''.join(self.stream(collector))
+
+    def stream(self, collector):
+        """
+        Yield the exposition of the collector one metric family at a time.
+        Only the family being rendered is held in its encoded form.
+        """
+        label_strings = {}
+        for metric in self._select(collector.collect()):
+            output = _render_text(metric, label_strings) if self._direct else None
+            if output is None:
+                output = self._encode(CollectedFamilies([metric]))
+                if self._openmetrics:
+                    output = output[:-len(OPENMETRICS_EOF)]
+            yield output
+
+        if self._openmetrics:
+            yield OPENMETRICS_EOF
+
+
+def is_openmetrics(content_type):
+    """
+    Return true if content_type designates the OpenMetrics text format.
+    """
+    return content_type.split(';', 1)[0] == OPENMETRICS_TYPE.split(';', 1)[0]
+
+
+def choose_encoder(accept_header):
+    """
+    Return an encoder and its content type based on the Accept header of a
+    request. Supports the OpenMetrics and the Prometheus text formats.
+    """
+    encode, content_type = _choose_encoder(accept_header)
+    if is_openmetrics(content_type):
+        return Encoder(encode, _without_clashes, True), content_type
+
+    escaping = dict(
+        param.strip().split('=', 1) for param in content_type.split(';')[1:]
+    ).get('escaping', UNDERSCORES)
+    direct = escaping in (UNDERSCORES, ALLOWUTF8)
+    return Encoder(encode, _without_created, False, direct), content_type
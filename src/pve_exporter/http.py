@@ -2,16 +2,35 @@
 HTTP API for Proxmox VE prometheus collector.
 """
 
+import collections
+import itertools
 import logging
+import math
+import os
 import time
+import zlib
 from functools import partial
 
 import gunicorn.app.base
-from prometheus_client import CONTENT_TYPE_LATEST, Summary, Counter, generate_latest
+from prometheus_client import REGISTRY, Summary, Counter
+from prometheus_client import CollectorRegistry, multiprocess
+from prometheus_client.exposition import choose_encoder as choose_registry_encoder
 from werkzeug.routing import Map, Rule
 from werkzeug.wrappers import Request, Response
 from werkzeug.exceptions import InternalServerError
+from pve_exporter.circuit import CircuitBreakers, CircuitOpen
 from pve_exporter.collector import collect_pve
+from pve_exporter.concurrency import SingleFlight
+from pve_exporter.config import exporter_settings
+from pve_exporter.exposition import choose_encoder
+from pve_exporter.snapshot import Precollector, precollect_jobs
+
+
+WebOptions = collections.namedtuple('WebOptions', [
+    'compression_level',
+    'compression_min_size',
+    'timeout_offset',
+], defaults=[6, 1024, 0.5])
 
 
 class PveExporterApplication:
@@ -19,10 +38,16 @@ class PveExporterApplication:
     Proxmox VE prometheus collector HTTP handler.
     """
 
-    def __init__(self, config, collectors, logger):
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, config, collectors, logger, web_options=WebOptions()):
         self._config = config
         self._collectors = collectors
         self._log = logger
+        self._web_options = web_options
+        self._inflight = SingleFlight()
+        self._breakers = CircuitBreakers()
+        self._precollector = Precollector(precollect_jobs(config), self._collect, logger)
 
         self._duration = Summary(
             'pve_collection_duration_seconds',
@@ -49,22 +74,41 @@ class PveExporterApplication:
         ])
 
 
-    def on_pve(self, module='default', target='localhost', cluster='1', node='1'):
+    def on_pve(self, module='default', target='localhost', cluster='1', node='1',
+               accept=None, scrape_timeout=None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
         """
         Request handler for /pve route
         """
 
         if module in self._config:
+            cluster = cluster.lower() not in ['false', '0', '']
+            if node.lower() == 'all':
+                node = 'all'
+            else:
+                node = node.lower() not in ['false', '0', '']
+            encoder, content_type = choose_encoder(accept)
+
+            snapshot = self._precollector.get(module, target, cluster, node)
+            if snapshot is not None:
+                response = Response(snapshot.render(encoder, content_type))
+                response.headers['content-type'] = content_type
+                response.headers['age'] = str(int(snapshot.age()))
+                return response
+
             start = time.time()
-            output = collect_pve(
-                self._config[module],
-                target,
-                cluster.lower() not in ['false', '0', ''],
-                node.lower() not in ['false', '0', ''],
-                self._collectors
-            )
-            response = Response(output)
-            response.headers['content-type'] = CONTENT_TYPE_LATEST
+            deadline = self._deadline(scrape_timeout)
+            try:
+                families = self._collect(module, target, cluster, node, deadline)
+            except CircuitOpen as error:
+                self._errors.labels(module).inc()
+                response = Response(str(error), status=503)
+                response.headers['retry-after'] = str(math.ceil(error.retry_after))
+                return response
+            # Stream the exposition family by family rather than rendering
+            # the whole response body into memory up front.
+            response = Response(encoder.stream(families))
+            response.headers['content-type'] = content_type
             self._duration.labels(module).observe(time.time() - start)
         else:
             response = Response(f"Module '{module}' not found in config")
@@ -72,13 +116,85 @@ class PveExporterApplication:
 
         return response
 
-    def on_metrics(self):
+    def _collect(self, module, target, cluster, node, deadline=None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        Collect metrics of a target using the given module config.
+
+        Concurrent requests with identical parameters, e.g., from a pair of
+        HA Prometheus servers, share a single collection. That collection is
+        bounded by the deadline of the request which started it. Requests
+        joining it wait no longer than their own deadline.
+
+        Raises CircuitOpen without collecting if the target failed to respond
+        repeatedly.
+        """
+        collect = partial(
+            collect_pve,
+            self._config[module],
+            target,
+            cluster,
+            node,
+            self._collectors,
+            module=module,
+            deadline=deadline,
+        )
+
+        settings = exporter_settings(self._config[module])
+        breaker = self._breakers.breaker(
+            module,
+            target,
+            settings['circuit_failures'],
+            settings['circuit_cooldown']
+        )
+        if breaker is not None:
+            collect = partial(breaker.call, collect)
+
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        return self._inflight.do((module, target, cluster, node), collect, timeout)
+
+    def _deadline(self, scrape_timeout):
+        """
+        Return the time.monotonic() based deadline of a scrape given the
+        value of the X-Prometheus-Scrape-Timeout-Seconds header. Returns None
+        if the header is missing or invalid.
+        """
+        try:
+            timeout = float(scrape_timeout)
+        except (TypeError, ValueError):
+            return None
+
+        if not 0 < timeout < float('inf'):
+            return None
+
+        # Leave some time to transfer the response. Ignore the offset if it
+        # would exceed the timeout itself.
+        offset = self._web_options.timeout_offset
+        if offset < timeout:
+            timeout -= offset
+
+        return time.monotonic() + timeout
+
+    def start_precollection(self):
+        """
+        Start background collection of the targets configured for it.
+        """
+        self._precollector.start()
+
+    def on_metrics(self, accept=None):
         """
         Request handler for /metrics route
         """
 
-        response = Response(generate_latest())
-        response.headers['content-type'] = CONTENT_TYPE_LATEST
+        registry = REGISTRY
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            # Aggregate metrics of all gunicorn worker processes.
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+
+        encoder, content_type = choose_registry_encoder(accept)
+        response = Response(encoder(registry))
+        response.headers['content-type'] = content_type
 
         return response
 
@@ -100,7 +216,7 @@ class PveExporterApplication:
 
         return response
 
-    def view(self, endpoint, values, args):
+    def view(self, endpoint, values, args, headers=None):
         """
         Werkzeug views mapping method.
         """
@@ -109,6 +225,8 @@ class PveExporterApplication:
             'pve': ['module', 'target', 'cluster', 'node']
         }
 
+        negotiated = ['pve', 'metrics']
+
         view_registry = {
             'index': self.on_index,
             'metrics': self.on_metrics,
@@ -118,6 +236,11 @@ class PveExporterApplication:
         params = dict(values)
         if endpoint in allowed_args:
             params.update({key: args[key] for key in allowed_args[endpoint] if key in args})
+        headers = headers or {}
+        if endpoint in negotiated:
+            params['accept'] = headers.get('accept')
+        if endpoint == 'pve':
+            params['scrape_timeout'] = headers.get('x-prometheus-scrape-timeout-seconds')
 
         try:
             return view_registry[endpoint](**params)
@@ -129,8 +252,65 @@ class PveExporterApplication:
     @Request.application
     def __call__(self, request):
         urls = self._url_map.bind_to_environ(request.environ)
-        view_func = partial(self.view, args=request.args)
-        return urls.dispatch(view_func, catch_http_exceptions=True)
+        view_func = partial(self.view, args=request.args, headers=request.headers)
+        response = urls.dispatch(view_func, catch_http_exceptions=True)
+        if isinstance(response, Response):
+            self._compress(request, response)
+        return response
+
+    def _compress(self, request, response):
+        """
+        Compress the response body if the client accepts gzip or deflate
+        encoding and the body is large enough to make it worthwhile.
+        """
+        level = self._web_options.compression_level
+        if level <= 0 or response.status_code != 200 or response.direct_passthrough:
+            return
+
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+        if encoding is None or 'content-encoding' in response.headers:
+            return
+
+        # Read ahead until the body is known to exceed the minimum size. This
+        # only buffers the first chunks of a streamed body.
+        chunks = response.iter_encoded()
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self._web_options.compression_min_size:
+                break
+        else:
+            response.set_data(b''.join(head))
+            return
+
+        body = _compressed(itertools.chain(head, chunks), encoding, level)
+        if response.is_streamed:
+            response.response = body
+            response.headers.pop('content-length', None)
+        else:
+            response.set_data(b''.join(body))
+        response.headers['content-encoding'] = encoding
+
+
+def _compressed(chunks, encoding, level):
+    """
+    Compress an iterable of chunks incrementally using gzip or deflate
+    encoding.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(level)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
 
 
 class StandaloneGunicornApplication(gunicorn.app.base.BaseApplication):
@@ -156,7 +336,7 @@ class StandaloneGunicornApplication(gunicorn.app.base.BaseApplication):
         return self.application
 
 
-def start_http_server(config, gunicorn_options, collectors):
+def start_http_server(config, gunicorn_options, collectors, web_options=WebOptions()):
     """
     Start a HTTP API server for Proxmox VE prometheus collector.
     """
@@ -165,5 +345,9 @@ def start_http_server(config, gunicorn_options, collectors):
     # exporter application.
     # https://trstringer.com/logging-flask-gunicorn-the-manageable-way/
     logger = logging.getLogger('gunicorn.error')
-    app = PveExporterApplication(config, collectors, logger)
-    StandaloneGunicornApplication(app, gunicorn_options).run()
+    app = PveExporterApplication(config, collectors, logger, web_options)
+
+    # Background threads do not survive the fork of the gunicorn master.
+    # Hence, start them in each worker process.
+    options = dict(gunicorn_options, post_worker_init=lambda _: app.start_precollection())
+    StandaloneGunicornApplication(app, options).run()
@@ -2,9 +2,18 @@
 Metrics concerning the operation of the Prometheus PVE exporter itself.
 """
 
+import collections
+import contextvars
+import threading
+import time
+from urllib.parse import urlsplit
+
 import wrapt
+from prometheus_client.core import GaugeMetricFamily
 from prometheus_client.metrics import Counter, Histogram
 
+from pve_exporter.collector import CollectedFamilies
+
 API_METRICS_ENABLED: bool = False
 """
 Whether or not api metrics are enabled
@@ -15,6 +24,33 @@ TARGET_METRICS_ENABLED: bool = False
 Whether or not target metrics are enabled
 """
 
+COLLECTOR_METRICS_ENABLED: bool = False
+"""
+Whether or not collector metrics are enabled
+"""
+
+API_URL_LIMIT: int = 256
+"""
+Maximum number of distinct url label values of api metrics. Calls to further
+urls are recorded with the url label set to "other". Url labels do not
+contain the target host, hence this bounds the number of distinct API paths
+rather than the number of targets.
+"""
+
+API_URL_PLACEHOLDERS = {
+    'nodes': '{node}',
+    'qemu': '{vmid}',
+    'lxc': '{vmid}',
+    'replication': '{id}',
+    'storage': '{storage}',
+    'tasks': '{upid}',
+    'pools': '{poolid}',
+}
+"""
+Path segments of the PVE API followed by an identifier and the placeholder
+replacing that identifier in the url label of api metrics.
+"""
+
 API_DURATION = Histogram(
     'pve_scrape_api_duration_seconds',
     'Duration of PVE API calls',
@@ -25,6 +61,11 @@ API_ERRORS = Counter(
     'Number of errors occured in PVE API calls',
     ['method', 'url']
 )
+API_QUEUE_DELAY = Histogram(
+    'pve_scrape_api_queue_delay_seconds',
+    'Time PVE API calls waited for the rate limit of the API host',
+    ['host']
+)
 
 TARGET_DURATION = Histogram(
     'pve_scrape_target_duration_seconds',
@@ -38,6 +79,125 @@ TARGET_ERRORS = Counter(
     ['target', 'cluster', 'node'],
 )
 
+COLLECTOR_DURATION = Histogram(
+    'pve_scrape_collector_duration_seconds',
+    'Duration of a collector run',
+    ['collector']
+)
+COLLECTOR_API_CALLS = Counter(
+    'pve_scrape_collector_api_calls_total',
+    'Number of PVE API calls issued by a collector',
+    ['collector']
+)
+
+CollectorRun = collections.namedtuple('CollectorRun', [
+    'collector',
+    'duration',
+    'api_calls',
+    'success',
+])
+
+_COLLECTOR_RUNS = contextvars.ContextVar('pve_collector_runs', default=None)
+"""
+List of CollectorRun tuples of the scrape in progress.
+"""
+
+_API_CALLS = contextvars.ContextVar('pve_api_calls', default=None)
+"""
+API call count of the collector in progress.
+"""
+
+
+_API_URLS = set()
+_API_URLS_LOCK = threading.Lock()
+
+
+def api_url_template(url):
+    """
+    Return the path of the url with identifiers replaced by placeholders.
+
+    E.g., https://pve:8006/api2/json/nodes/pve1/qemu/100/config becomes
+    /api2/json/nodes/{node}/qemu/{vmid}/config. Scheme and host are left out,
+    such that calls to different targets share the same label value.
+    """
+    _, separator, path = url.partition('/api2/json/')
+    if not separator:
+        return urlsplit(url).path
+
+    segments = path.split('/')
+    for index in range(1, len(segments)):
+        placeholder = API_URL_PLACEHOLDERS.get(segments[index - 1])
+        if placeholder:
+            segments[index] = placeholder
+
+    return separator + '/'.join(segments)
+
+
+def _api_url_label(url):
+    """
+    Return the url label value for an api call, bounded by API_URL_LIMIT.
+    """
+    template = api_url_template(url)
+    with _API_URLS_LOCK:
+        if template in _API_URLS:
+            return template
+        if len(_API_URLS) < API_URL_LIMIT:
+            _API_URLS.add(template)
+            return template
+
+    return 'other'
+
+
+class _CallCount:
+    """
+    Thread-safe count of API calls. Collectors may issue API calls from
+    multiple threads.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def increment(self):  # pylint: disable=missing-docstring
+        with self._lock:
+            self.value += 1
+
+
+def _target_labels(args):
+    """
+    Return the target, cluster and node label values of a collect_pve call.
+    The node argument may be 'all' instead of a boolean.
+    """
+    node = args[3] if args[3] == 'all' else int(args[3])
+    return args[1], int(args[2]), node
+
+
+def _collector_families(runs):
+    """
+    Return metric families describing the collector runs of a scrape.
+    """
+    duration = GaugeMetricFamily(
+        'pve_scrape_collector_duration_seconds',
+        'Duration of a collector run',
+        labels=['collector'])
+    api_calls = GaugeMetricFamily(
+        'pve_scrape_collector_api_calls',
+        'Number of PVE API calls issued by a collector',
+        labels=['collector'])
+    success = GaugeMetricFamily(
+        'pve_scrape_collector_success',
+        'Whether or not a collector succeeded',
+        labels=['collector'])
+
+    for run in sorted(runs):
+        duration.add_metric([run.collector], run.duration)
+        api_calls.add_metric([run.collector], run.api_calls)
+        success.add_metric([run.collector], run.success)
+
+    return [duration, api_calls, success]
+
 @wrapt.patch_function_wrapper(
     'proxmoxer.core',
     'ProxmoxResource._request',
@@ -45,19 +205,79 @@ TARGET_ERRORS = Counter(
 )
 def _api_metrics(wrapped, instance, args, kwargs):
     # pylint: disable=protected-access
-    errors = API_ERRORS.labels(args[0], instance._store["base_url"])
-    duration = API_DURATION.labels(args[0], instance._store["base_url"])
+    url = _api_url_label(instance._store["base_url"])
+    errors = API_ERRORS.labels(args[0], url)
+    duration = API_DURATION.labels(args[0], url)
     with errors.count_exceptions(), duration.time():
         return wrapped(*args, **kwargs)
 
+@wrapt.patch_function_wrapper(
+    'pve_exporter.api',
+    'HostLimiter.acquire',
+    lambda: API_METRICS_ENABLED
+)
+def _api_queue_delay(wrapped, instance, args, kwargs):
+    with API_QUEUE_DELAY.labels(instance.host).time():
+        return wrapped(*args, **kwargs)
+
 @wrapt.patch_function_wrapper(
     'pve_exporter.collector',
     'collect_pve',
     lambda: TARGET_METRICS_ENABLED
 )
 def _target_metrics(wrapped, _, args, kwargs):
-    # pylint: disable=protected-access
-    errors = TARGET_ERRORS.labels(args[1], int(args[2]), int(args[3]))
-    duration = TARGET_DURATION.labels(args[1], int(args[2]), int(args[3]))
+    errors = TARGET_ERRORS.labels(*_target_labels(args))
+    duration = TARGET_DURATION.labels(*_target_labels(args))
     with errors.count_exceptions(), duration.time():
         return wrapped(*args, **kwargs)
+
+@wrapt.patch_function_wrapper(
+    'proxmoxer.core',
+    'ProxmoxResource._request',
+    lambda: COLLECTOR_METRICS_ENABLED
+)
+def _collector_api_calls(wrapped, _, args, kwargs):
+    calls = _API_CALLS.get()
+    if calls is not None:
+        calls.increment()
+    return wrapped(*args, **kwargs)
+
+@wrapt.patch_function_wrapper(
+    'pve_exporter.collector',
+    '_run_collector',
+    lambda: COLLECTOR_METRICS_ENABLED
+)
+def _collector_metrics(wrapped, _, args, kwargs):
+    name = args[2][0]
+    calls = _CallCount()
+    token = _API_CALLS.set(calls)
+    success = 0
+    start = time.perf_counter()
+    try:
+        families = wrapped(*args, **kwargs)
+        success = 1
+        return families
+    finally:
+        duration = time.perf_counter() - start
+        _API_CALLS.reset(token)
+        COLLECTOR_DURATION.labels(name).observe(duration)
+        COLLECTOR_API_CALLS.labels(name).inc(calls.value)
+
+        runs = _COLLECTOR_RUNS.get()
+        if runs is not None:
+            runs.append(CollectorRun(name, duration, calls.value, success))
+
+@wrapt.patch_function_wrapper(
+    'pve_exporter.collector',
+    'collect_pve',
+    lambda: COLLECTOR_METRICS_ENABLED
+)
+def _collector_target_metrics(wrapped, _, args, kwargs):
+    runs = []
+    token = _COLLECTOR_RUNS.set(runs)
+    try:
+        families = wrapped(*args, **kwargs)
+    finally:
+        _COLLECTOR_RUNS.reset(token)
+
+    return CollectedFamilies(list(families.collect()) + _collector_families(runs))
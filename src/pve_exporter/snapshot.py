@@ -0,0 +1,158 @@
+"""
+Background pre-collection for Proxmox VE prometheus collector.
+"""
+
+import threading
+import time
+from collections.abc import Mapping
+
+from prometheus_client.core import GaugeMetricFamily
+
+from pve_exporter.circuit import CircuitOpen
+from pve_exporter.collector import CollectedFamilies
+from pve_exporter.config import exporter_settings
+from pve_exporter.exposition import OPENMETRICS_EOF
+
+PRECOLLECT_MAX_AGE_INTERVALS = 3
+"""
+Number of precollect intervals after which a snapshot is no longer served
+unless the precollect_max_age setting says otherwise.
+"""
+
+
+class Snapshot:
+    """
+    Metric families collected in the background.
+
+    The exposition is rendered once per format and kept along with the
+    families.
+    """
+
+    def __init__(self, families, collected_at):
+        self.families = families
+        self.collected_at = collected_at
+        self._lock = threading.Lock()
+        self._rendered = {}
+
+    def age(self):
+        """
+        Return the number of seconds since the snapshot was collected.
+        """
+        return max(0.0, time.time() - self.collected_at)
+
+    def render(self, encoder, content_type):
+        """
+        Return the snapshot exposition followed by the snapshot age metric.
+        """
+        with self._lock:
+            output = self._rendered.get(content_type)
+            if output is None:
+                output = self._rendered[content_type] = encoder(self.families)
+
+        age_metric = GaugeMetricFamily(
+            'pve_exporter_snapshot_age_seconds',
+            'Seconds since the served metrics were collected in the background.',
+            value=self.age()
+        )
+
+        # Both parts of an OpenMetrics exposition are terminated by an EOF
+        # marker. Only keep the last one.
+        if output.endswith(OPENMETRICS_EOF):
+            output = output[:-len(OPENMETRICS_EOF)]
+
+        return output + encoder(CollectedFamilies([age_metric]))
+
+
+def precollect_jobs(config):
+    """
+    Return a list of ((module, target, cluster, node), interval, max_age)
+    tuples for all targets configured for background collection.
+    """
+    jobs = []
+    for module, module_config in config.items():
+        settings = exporter_settings(module_config)
+        interval = settings['precollect_interval']
+        max_age = settings['precollect_max_age'] or PRECOLLECT_MAX_AGE_INTERVALS * interval
+        for entry in settings['precollect_targets']:
+            if isinstance(entry, Mapping):
+                node = entry.get('node', True)
+                key = (
+                    module,
+                    str(entry['target']),
+                    bool(entry.get('cluster', True)),
+                    'all' if node == 'all' else bool(node),
+                )
+            else:
+                key = (module, str(entry), True, True)
+            jobs.append((key, interval, max_age))
+
+    return jobs
+
+
+class Precollector:
+    """
+    Periodically collects configured targets in background threads and keeps
+    the latest metrics of every target in memory.
+
+    The collect callable is called with module, target, cluster and node and
+    is expected to return the collected metric families of the target.
+
+    Snapshots older than the max_age of their job are discarded, such that
+    scrapes fall back to live collection if background collection keeps
+    failing.
+    """
+
+    def __init__(self, jobs, collect, logger):
+        self._jobs = jobs
+        self._collect = collect
+        self._log = logger
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self._max_ages = {key: max_age for key, _, max_age in jobs}
+        self._threads = []
+
+    def start(self):
+        """
+        Start one background thread per configured target.
+        """
+        if self._threads:
+            return
+
+        for key, interval, _ in self._jobs:
+            thread = threading.Thread(
+                target=self._run,
+                args=(key, interval),
+                name=f"precollect-{key[0]}-{key[1]}",
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def get(self, module, target, cluster, node):
+        """
+        Return the latest snapshot for the given scrape parameters or None if
+        no snapshot is available or the latest one is too old.
+        """
+        key = (module, target, cluster, node)
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and snapshot.age() > self._max_ages[key]:
+                del self._snapshots[key]
+                snapshot = None
+
+            return snapshot
+
+    def _run(self, key, interval):
+        while True:
+            started = time.monotonic()
+            try:
+                families = self._collect(*key)
+            except CircuitOpen as error:
+                self._log.warning("Skipping background collection: %s", error)
+            except Exception:  # pylint: disable=broad-except
+                self._log.exception("Exception thrown while collecting %s in background", key[1])
+            else:
+                with self._lock:
+                    self._snapshots[key] = Snapshot(families, time.time())
+
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))